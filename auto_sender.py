@@ -10,6 +10,12 @@ import pandas as pd
 import psutil
 import subprocess
 import sys
+import preflight
+import profiling
+import scheduler
+from sender_service import now # Общий источник времени с сервисом (подменяется в симуляторе)
+from sender_service import get_stop_request_path
+from sender_service import get_files_for_sending # Тот же поиск файлов, что и в сервисе
 
 # Настройка страницы Streamlit
 st.set_page_config(
@@ -70,19 +76,30 @@ def stop_service():
     """Останавливает сервис отправки"""
     try:
         stopped_any = False
-        # Итерируемся по всем запущенным процессам
+        service_procs = []
         for proc in psutil.process_iter(['pid', 'name', 'cmdline']):
             try:
                 # Проверяем, содержит ли командная строка процесса имя файла сервиса
                 if proc.info['cmdline'] and 'sender_service.py' in ' '.join(proc.info['cmdline']):
-                    # Принудительно завершаем процесс
+                    service_procs.append(proc)
+            except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+                pass
+        if service_procs:
+            # Сначала просим сервис остановиться самому: он допишет текущее письмо
+            # и сохранит контрольную точку. На Windows terminate() не дает ему такой возможности.
+            with open(get_stop_request_path(), 'w', encoding='utf-8') as f:
+                f.write(datetime.now().isoformat())
+            gone, alive = psutil.wait_procs(service_procs, timeout=15)
+            stopped_any = bool(gone)
+            for proc in alive:
+                try:
+                    # Сервис не остановился за таймаут - завершаем принудительно
                     proc.terminate()
-                    # Ждем завершения процесса до 3 секунд
                     proc.wait(timeout=3)
                     stopped_any = True
-            except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess, subprocess.TimeoutExpired):
-                # Игнорируем ошибки или процессы, которые не удалось завершить за таймаут
-                pass
+                except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess, psutil.TimeoutExpired):
+                    # Игнорируем ошибки или процессы, которые не удалось завершить за таймаут
+                    pass
         if stopped_any:
             st.sidebar.success("Сервис отправки остановлен!")
         else:
@@ -164,74 +181,23 @@ def connect_outlook():
         return None
 
 # --- ОБНОВЛЕННАЯ ФУНКЦИЯ get_files_for_today для ПРЕДВАРИТЕЛЬНОГО ПРОСМОТРА ---
-# (Используется ТОЛЬКО на странице "Отправка файлов" для показа файлов,
-#  которые подходят по date_config НА ДАННЫЙ МОМЕНТ)
+# (Используется на странице "Отправка файлов" для показа файлов,
+#  которые подходят по date_config НА ДАННЫЙ МОМЕНТ, и для ручной отправки)
 def get_files_for_today(folder_path):
     """
     Ищет файлы для отправки на основе настроек date_config (предварительный просмотр).
-    Для каждого склада определяет целевую дату файла (сегодня + days_offset или send_on_friday).
-    Ищет файлы с датой в формате YYYYMMDD и кодом склада в начале имени.
+    Использует поиск сервиса (sender_service.get_files_for_sending), поэтому в просмотр
+    и ручную отправку попадают те же файлы, что отправит сервис, включая файлы,
+    маршрутизированные по содержимому книги (content_routing).
     """
     try:
-        today_dt_obj = datetime.now() # Получаем объект datetime для проверки дня недели
-        config = load_config() # Загружаем конфигурацию
-        date_config = config.get('date_config', {}) # Получаем date_config
-        email_config = config.get('email_config', {}) # Получаем email_config
-
-        grouped_files = {}
-
-        # Используем date_config для определения дат файлов для каждого склада
-        for warehouse_code, date_info in date_config.items():
-            # Получаем email для склада
-            email = email_config.get(warehouse_code)
-            # Пропускаем склад, если нет email
-            if not email:
-                logging.debug(f"Пропущен склад {warehouse_code}: нет email в конфигурации.")
-                continue
-
-            # Определяем смещение в зависимости от дня недели
-            days_offset = date_info.get('days_offset', 0)
-            # Проверяем, является ли сегодня пятницей (weekday() == 4)
-            if today_dt_obj.weekday() == 4:  # Пятница
-                days_offset = date_info.get('send_on_friday', days_offset)
-
-            # Рассчитываем ЦЕЛЕВУЮ дату для поиска файлов
-            target_date = today_dt_obj + timedelta(days=days_offset)
-            # Формат даты в файле: YYYYMMDD (без точек)
-            target_date_str = target_date.strftime('%Y%m%d')
-
-            logging.debug(f"Предпросмотр для склада {warehouse_code}: поиск файлов с датой {target_date_str} (offset: {days_offset})")
-
-            if not os.path.exists(folder_path):
-                st.error(f"❌ Папка {folder_path} не существует")
-                logging.error(f"Папка {folder_path} не существует")
-                return {} # Если папка не существует, возвращаем пустой результат
+        if not os.path.exists(folder_path):
+            st.error(f"❌ Папка {folder_path} не существует")
+            logging.error(f"Папка {folder_path} не существует")
+            return {} # Если папка не существует, возвращаем пустой результат
 
-            try:
-                files = os.listdir(folder_path)
-            except OSError as e:
-                st.error(f"❌ Ошибка доступа к папке {folder_path}: {e}")
-                logging.error(f"Ошибка доступа к папке {folder_path}: {e}")
-                return {}
-
-            # --- ЛОГИКА ГРУППИРОВКИ ПО СКЛАДУ ---
-            # Ищем файлы, которые НАЧИНАЮТСЯ с кода склада и содержат целевую дату
-            for file in files:
-                if file.lower().endswith('.xlsx'):
-                    # Проверяем, НАЧИНАЕТСЯ ли имя файла с кода склада и содержит ли ЦЕЛЕВУЮ дату
-                    # Пример: файл "7210_20250815_..." должен подходить для склада "7210"
-                    if file.startswith(f"{warehouse_code}_") and target_date_str in file:
-                        # Если группа для склада еще не создана, создаем её
-                        if warehouse_code not in grouped_files:
-                            grouped_files[warehouse_code] = {
-                                'email': email,
-                                'files': []
-                            }
-                        # Добавляем файл в группу склада
-                        grouped_files[warehouse_code]['files'].append(file)
-                        logging.debug(f"Найден файл для склада {warehouse_code}: {file}")
-
-        return grouped_files
+        config = load_config() # Загружаем конфигурацию
+        return get_files_for_sending(folder_path, config)
     except Exception as e:
         st.error(f"❌ Ошибка поиска файлов: {str(e)}")
         logging.error(f"Ошибка поиска файлов: {str(e)}")
@@ -268,7 +234,7 @@ def send_files_now():
         logging.info("Начало отправки файлов")
 
         # Проверяем выходной день
-        today = datetime.now()
+        today = now()
         if today.weekday() in [5, 6]:  # Суббота=5, Воскресенье=6
             st.info("ℹ️ Сегодня выходной день. Отправка не производится.")
             logging.info("Сегодня выходной день. Отправка не производится.")
@@ -285,6 +251,20 @@ def send_files_now():
             logging.info("Нет файлов для отправки сегодня")
             return False
 
+        # Проверяем вложения так же, как сервис: файлы из карантина не отправляются
+        checked_files = preflight.run_preflight(config['folder_path'], grouped_files, config)
+        quarantined_files = [
+            f for code, data in grouped_files.items() for f in data['files']
+            if f not in checked_files.get(code, {}).get('files', [])
+        ]
+        if quarantined_files:
+            st.warning(f"⚠️ Файлы в карантине не будут отправлены: {', '.join(quarantined_files)}")
+        grouped_files = checked_files
+        if not grouped_files:
+            st.warning("⚠️ Все файлы для отправки в карантине. Отправка не производится.")
+            logging.info("Все файлы для отправки в карантине. Отправка не производится.")
+            return False
+
         # Подключаемся к Outlook
         outlook = connect_outlook()
         if not outlook:
@@ -347,14 +327,18 @@ if page == "Конфигурация":
         email_df = pd.DataFrame(email_data)
         edited_email_df = st.data_editor(email_df, num_rows="dynamic", key="email_editor")
         st.subheader("Конфигурация дат файлов")
-        st.write("Укажите количество дней к сегодняшней дате для каждого склада:")
+        st.write("Укажите количество дней к сегодняшней дате для каждого склада. "
+                 "Приоритет (меньше - важнее) и срок доставки ЧЧ:ММ определяют порядок отправки при очереди; "
+                 "пустые значения вычисляются по количеству дней до даты документов:")
         # Создаем DataFrame для редактирования date_config
         date_data = []
         for code, date_info in config.get('date_config', {}).items():
             date_data.append({
                 "Код склада": code,
                 "Дней к сегодняшней дате": date_info.get('days_offset', 0),
-                "Отправка в пятницу": date_info.get('send_on_friday', 0)
+                "Отправка в пятницу": date_info.get('send_on_friday', 0),
+                "Приоритет": date_info.get('priority'),
+                "Срок доставки": date_info.get('deadline')
             })
         date_df = pd.DataFrame(date_data)
         edited_date_df = st.data_editor(date_df, num_rows="dynamic", key="date_editor")
@@ -377,7 +361,23 @@ if page == "Конфигурация":
                     except ValueError:
                         days_offset = 0
                         send_on_friday = 0
-                    date_config[code] = {"days_offset": days_offset, "send_on_friday": send_on_friday}
+                    try:
+                        priority = int(row["Приоритет"]) if pd.notna(row["Приоритет"]) and str(row["Приоритет"]).strip() else None
+                    except ValueError:
+                        priority = None
+                    deadline = str(row["Срок доставки"]).strip() if pd.notna(row["Срок доставки"]) else ""
+                    # Сохраняем прочие настройки склада, которых нет в таблице
+                    date_config[code] = dict(config.get('date_config', {}).get(code, {}))
+                    date_config[code].update({
+                        "days_offset": days_offset,
+                        "send_on_friday": send_on_friday
+                    })
+                    # Пустые приоритет и срок не сохраняются - они вычисляются автоматически
+                    for key, value in (("priority", priority), ("deadline", deadline)):
+                        if value is None or value == "":
+                            date_config[code].pop(key, None)
+                        else:
+                            date_config[code][key] = value
             # Обновляем конфигурацию
             config['folder_path'] = folder_path
             # config['schedule_times'] = schedule_times # Не обновляем, так как не используется сервисом
@@ -426,6 +426,25 @@ elif page == "Отправка файлов":
                     st.code(file)
     else:
         st.info("ℹ️ Нет файлов для отправки сегодня (предварительный просмотр)")
+    # Соблюдение сроков доставки (считает сервис)
+    dispatch_metrics = scheduler.load_state()['metrics']
+    if dispatch_metrics:
+        st.subheader("⏰ Сроки доставки")
+        st.dataframe(pd.DataFrame([
+            {"Склад": code, "Отправлено": m.get('sent', 0), "С опозданием": m.get('missed', 0),
+             "Макс. опоздание, мин": m.get('max_late_minutes', 0), "Последнее опоздание": m.get('last_missed', '')}
+            for code, m in sorted(dispatch_metrics.items())
+        ]), use_container_width=True)
+    # Файлы, не прошедшие предварительную проверку сервиса
+    quarantine = preflight.load_quarantine()
+    if quarantine:
+        st.subheader(f"🚫 Карантин ({len(quarantine)})")
+        st.warning("Эти файлы повреждены или не дописаны и не отправляются. Исправьте файл - сервис проверит его заново.")
+        quarantine_df = pd.DataFrame([
+            {"Файл": name, "Причина": info.get('reason'), "Обнаружен": info.get('detected_at')}
+            for name, info in quarantine.items()
+        ])
+        st.dataframe(quarantine_df, use_container_width=True)
 
 # Страница логов
 elif page == "Логи":
@@ -481,6 +500,46 @@ elif page == "Логи":
     except Exception as e:
         st.error(f"Ошибка чтения логов сервиса: {str(e)}")
 
+    # Профилирование циклов сервиса (настройка читается сервисом в начале каждого цикла)
+    st.subheader("⏱️ Профилирование циклов сервиса")
+    config = load_config()
+    profiling_config = dict(profiling.DEFAULT_PROFILING_CONFIG)
+    profiling_config.update(config.get('profiling', {}))
+    with st.form("profiling_form"):
+        profiling_enabled = st.checkbox("Записывать длительность этапов каждого цикла", value=profiling_config['enabled'])
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            cprofile_enabled = st.checkbox("cProfile для медленных циклов", value=profiling_config['cprofile'])
+        with col2:
+            tracemalloc_enabled = st.checkbox("tracemalloc для медленных циклов", value=profiling_config['tracemalloc'])
+        with col3:
+            slowest_cycles = st.number_input("Сколько медленных циклов хранить", min_value=1, max_value=50,
+                                             value=int(profiling_config['slowest_cycles']))
+        if st.form_submit_button("💾 Сохранить настройки профилирования"):
+            config['profiling'] = {
+                "enabled": profiling_enabled,
+                "slowest_cycles": int(slowest_cycles),
+                "cprofile": cprofile_enabled,
+                "tracemalloc": tracemalloc_enabled
+            }
+            save_config(config)
+    span_summary = profiling.summarize_spans()
+    if span_summary:
+        st.write("**Самые медленные этапы (по записанным циклам, мс):**")
+        st.dataframe(pd.DataFrame(span_summary).rename(columns={
+            'span': 'Этап', 'count': 'Циклов', 'mean_ms': 'Среднее', 'p95_ms': 'p95', 'max_ms': 'Максимум'
+        }), use_container_width=True)
+        slowest = profiling.load_slowest_cycles()
+        if slowest:
+            st.write(f"**Самые медленные циклы (профили в {profiling.get_profiles_dir()}):**")
+            st.dataframe(pd.DataFrame([
+                {"Начало": c['started_at'], "Длительность, мс": c['total_ms'],
+                 "cProfile": c.get('cprofile_file', ''), "tracemalloc": c.get('tracemalloc_file', '')}
+                for c in slowest
+            ]), use_container_width=True)
+    else:
+        st.info("Нет данных профилирования. Включите профилирование и дождитесь следующего цикла сервиса.")
+
 
 # Страница инструкции
 elif page == "Инструкция":
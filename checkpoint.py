@@ -0,0 +1,306 @@
+"""
+Контрольная точка сервиса для быстрого перезапуска без повторных отправок.
+
+Состояние сохраняется в logs/checkpoint.json после каждого письма:
+    in_flight - письма, переданные в mail.Send(), но еще не записанные в журнал, с ключами идемпотентности;
+    pending   - группы, запланированные к отправке в текущем цикле, но еще не отправленные.
+
+Курсор сканирования - последний список файлов папки и время изменения папки - хранится
+отдельно в logs/scan_cursor.json и записывается только после нового listdir. Пока папка
+не менялась, повторный listdir не нужен, в том числе после перезапуска, а большой список
+файлов не переписывается вместе с контрольной точкой после каждого письма.
+
+Письмо попадает в in_flight непосредственно перед mail.Send(), а его ключ
+идемпотентности сохраняется в самом письме (именованное MAPI-свойство
+AutoSenderKey). Если сервис был убит между mail.Send() и записью журнала
+отправленных файлов, в первом цикле с подключением к Outlook письма из in_flight
+ищутся по ключу в папках "Отправленные" и "Исходящие". Найденные письма считаются
+отправленными и их файлы заносятся в журнал; ненайденные отправляются повторно.
+
+Цикл отправки выполняется под файлом блокировки logs/cycle.lock, чтобы сервис и
+sender_cli не отправляли одни и те же файлы одновременно. Под блокировкой
+контрольная точка перечитывается с диска и записывается в конце цикла.
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+from datetime import datetime
+
+# Кэш листинга используется, только если папка не менялась как минимум столько секунд
+# до момента листинга (защита от грубой точности времени изменения на сетевых дисках).
+SCAN_MTIME_MARGIN_SEC = 2
+
+# Именованное MAPI-свойство письма с ключом идемпотентности (пространство PS_PUBLIC_STRINGS).
+# Записывается через PropertyAccessor: пользовательские свойства (UserProperties) заставляют
+# Outlook отправлять письмо в формате TNEF, и внешние получатели видят winmail.dat вместо вложений.
+KEY_PROPERTY = "http://schemas.microsoft.com/mapi/string/{00020329-0000-0000-C000-000000000046}/AutoSenderKey"
+# Папки Outlook, в которых ищутся прерванные отправки: "Отправленные" и "Исходящие"
+OL_FOLDER_SENT_MAIL = 5
+OL_FOLDER_OUTBOX = 4
+
+_state = None
+# Курсор сканирования папки (None - еще не загружен)
+_scan = None
+# Открытый файл блокировки цикла (None - блокировка не захвачена этим процессом)
+_lock_file = None
+
+
+def get_checkpoint_path():
+    """Возвращает путь к файлу контрольной точки."""
+    return os.path.join("logs", "checkpoint.json")
+
+
+def get_scan_path():
+    """Возвращает путь к курсору сканирования папки."""
+    return os.path.join("logs", "scan_cursor.json")
+
+
+def write_json(path, data):
+    """Атомарно записывает JSON: во временный файл, затем os.replace."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = path + ".tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+    os.replace(temp_path, path)
+
+
+def load():
+    """Загружает контрольную точку с диска (один раз за процесс)."""
+    global _state
+    if _state is not None:
+        return _state
+    _state = {'in_flight': {}, 'pending': {}}
+    path = get_checkpoint_path()
+    if os.path.exists(path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+                if isinstance(data, dict):
+                    for key in _state:
+                        if isinstance(data.get(key), dict):
+                            _state[key] = data[key]
+        except Exception as e:
+            logging.error(f"Ошибка загрузки контрольной точки {path}: {e}")
+    return _state
+
+
+def reset():
+    """Сбрасывает состояние в памяти; следующее обращение перечитает файлы (смена рабочей папки)."""
+    global _state, _scan
+    _state = None
+    _scan = None
+
+
+def flush():
+    """Атомарно записывает контрольную точку на диск."""
+    state = load()
+    path = get_checkpoint_path()
+    try:
+        write_json(path, dict(state, updated_at=datetime.now().isoformat(timespec='seconds')))
+    except Exception as e:
+        logging.error(f"Ошибка сохранения контрольной точки {path}: {e}")
+
+
+def load_scan():
+    """Загружает курсор сканирования папки с диска (один раз за процесс)."""
+    global _scan
+    if _scan is not None:
+        return _scan
+    _scan = {}
+    path = get_scan_path()
+    if os.path.exists(path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+                if isinstance(data, dict):
+                    _scan = data
+        except Exception as e:
+            logging.error(f"Ошибка загрузки курсора сканирования {path}: {e}")
+    return _scan
+
+
+def get_lock_path():
+    """Возвращает путь к файлу блокировки цикла отправки."""
+    return os.path.join("logs", "cycle.lock")
+
+
+def lock_file(f):
+    """Неблокирующая исключительная блокировка открытого файла средствами ОС."""
+    if os.name == 'nt':
+        import msvcrt
+        msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+    else:
+        import fcntl
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+
+def unlock_file(f):
+    """Снимает блокировку, установленную lock_file."""
+    if os.name == 'nt':
+        import msvcrt
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        import fcntl
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def acquire_lock():
+    """
+    Захватывает блокировку цикла отправки. Возвращает False, если цикл уже
+    выполняется другим процессом. После захвата состояние перечитывается с диска.
+    Блокировку держит ОС, поэтому после аварийного завершения процесса она снимается сама.
+    """
+    global _lock_file
+    if _lock_file is not None:
+        return False
+    path = get_lock_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    f = open(path, 'a+', encoding='utf-8')
+    try:
+        f.seek(0)
+        lock_file(f)
+    except OSError:
+        f.close()
+        return False
+    f.seek(0)
+    f.truncate()
+    f.write(f"{os.getpid()} {datetime.now().isoformat(timespec='seconds')}")
+    f.flush()
+    _lock_file = f
+    reset()
+    return True
+
+
+def release_lock():
+    """Записывает контрольную точку и снимает блокировку цикла отправки."""
+    global _lock_file
+    flush()
+    if _lock_file is None:
+        return
+    try:
+        unlock_file(_lock_file)
+    except OSError as e:
+        logging.error(f"Не удалось снять блокировку цикла {get_lock_path()}: {e}")
+    finally:
+        _lock_file.close()
+        _lock_file = None
+
+
+def list_folder(folder_path):
+    """
+    Возвращает список файлов папки. Если время изменения папки совпадает с
+    сохраненным курсором, используется сохраненный список без listdir.
+    Курсор записывается на диск только после нового listdir.
+    """
+    global _scan
+    scan = load_scan()
+    mtime_ns = os.stat(folder_path).st_mtime_ns
+    if (scan.get('folder_path') == folder_path and scan.get('mtime_ns') == mtime_ns
+            and scan.get('listed_at', 0) - mtime_ns / 1e9 > SCAN_MTIME_MARGIN_SEC):
+        return list(scan['files'])
+    files = os.listdir(folder_path)
+    _scan = {
+        'folder_path': folder_path,
+        'mtime_ns': mtime_ns,
+        'listed_at': time.time(),
+        'files': files
+    }
+    try:
+        write_json(get_scan_path(), _scan)
+    except Exception as e:
+        logging.error(f"Ошибка сохранения курсора сканирования {get_scan_path()}: {e}")
+    return files
+
+
+def idempotency_key(warehouse_code, email, files):
+    """Ключ идемпотентности письма: склад, получатель и набор файлов."""
+    raw = "|".join([warehouse_code, email] + sorted(files))
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def set_pending(groups):
+    """Запоминает группы, запланированные к отправке в этом цикле."""
+    load()['pending'] = {code: {'email': data['email'], 'files': list(data['files'])} for code, data in groups.items()}
+    flush()
+
+
+def tag_mail(mail, key):
+    """Сохраняет ключ идемпотентности в письме (именованное MAPI-свойство)."""
+    mail.PropertyAccessor.SetProperty(KEY_PROPERTY, key)
+
+
+def begin_send(key, warehouse_code, email, files, subject=None):
+    """Отмечает письмо как отправляемое. Вызывается непосредственно перед mail.Send()."""
+    load()['in_flight'][key] = {
+        'warehouse': warehouse_code,
+        'email': email,
+        'subject': subject,
+        'files': list(files),
+        'started_at': datetime.now().isoformat(timespec='seconds')
+    }
+    flush()
+
+
+def finish_send(key, warehouse_code):
+    """Снимает письмо с отправки и из ожидающих групп (после записи журнала)."""
+    state = load()
+    state['in_flight'].pop(key, None)
+    state['pending'].pop(warehouse_code, None)
+    flush()
+
+
+def abort_send(key):
+    """Снимает неудавшуюся отправку; группа остается в ожидающих."""
+    load()['in_flight'].pop(key, None)
+    flush()
+
+
+def log_unfinished():
+    """Сообщает в лог о незавершенной работе предыдущего запуска. Вызывается при запуске сервиса."""
+    state = load()
+    if state['in_flight']:
+        logging.warning(f"Прерванных отправок: {len(state['in_flight'])}. Они будут сверены с папкой 'Отправленные' в первом цикле.")
+    if state['pending']:
+        logging.info(f"Незавершенные группы предыдущего запуска: {', '.join(state['pending'])}. Будут отправлены в первом цикле.")
+
+
+def find_sent_keys(outlook, in_flight):
+    """Ищет письма с ключами из in_flight в папках "Отправленные" и "Исходящие"."""
+    found = set()
+    for folder_id in (OL_FOLDER_SENT_MAIL, OL_FOLDER_OUTBOX):
+        items = outlook.Session.GetDefaultFolder(folder_id).Items
+        for key in in_flight:
+            # Ключ - шестнадцатеричная строка, экранирование в запросе DASL не нужно
+            if key not in found and items.Restrict('@SQL="%s" = \'%s\'' % (KEY_PROPERTY, key)).Count:
+                found.add(key)
+    return found
+
+
+def recover_in_flight(outlook):
+    """
+    Сверяет прерванные отправки с папками Outlook и очищает in_flight.
+    Возвращает (файлы найденных писем - их нужно занести в журнал,
+    файлы, которые пока нельзя проверить - их нельзя отправлять в этом цикле).
+    """
+    state = load()
+    if not state['in_flight']:
+        return set(), set()
+    try:
+        found = find_sent_keys(outlook, state['in_flight'])
+    except Exception as e:
+        logging.error(f"Не удалось проверить прерванные отправки в папке 'Отправленные': {e}. Повторная проверка в следующем цикле.")
+        return set(), {f for entry in state['in_flight'].values() for f in entry.get('files', [])}
+    recovered = set()
+    for key, entry in state['in_flight'].items():
+        description = f"Прерванная отправка склада {entry.get('warehouse')} на {entry.get('email')} (начата {entry.get('started_at')})"
+        if key in found:
+            logging.warning(f"{description}: письмо найдено в Outlook, файлы отмечены отправленными: {', '.join(entry.get('files', []))}")
+            recovered.update(entry.get('files', []))
+        else:
+            logging.warning(f"{description}: письмо не найдено в Outlook и будет отправлено повторно")
+    state['in_flight'] = {}
+    flush()
+    return recovered, set()
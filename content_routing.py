@@ -0,0 +1,266 @@
+"""
+Определение склада и даты документа по содержимому .xlsx.
+
+Нужен для выгрузок, которые не могут назвать файл по правилу
+[КодСклада]_[ГГГГММДД]_*.xlsx. Для таких файлов читаются только свойства книги
+(docProps/custom.xml и docProps/core.xml) или заданные ячейки заголовка первого
+листа. Лист читается потоково (iterparse) и только до строки с нужными ячейками,
+поэтому книга никогда не загружается в память целиком.
+
+    "content_routing": {
+        "enabled": true,
+        "warehouse_property": "Склад",
+        "date_property": "ДатаДокумента",
+        "warehouse_cell": "B1",
+        "date_cell": "B2"
+    }
+
+Свойство ищется сначала среди пользовательских свойств книги, затем среди
+стандартных (title, subject, category, keywords, description). Если свойство
+не задано или пустое, используется ячейка. Результаты кэшируются по отпечатку
+файла (размер + время изменения) в logs/content_routing_cache.json, поэтому
+каждая книга открывается не более одного раза.
+"""
+import os
+import re
+import logging
+import zipfile
+import posixpath
+import xml.etree.ElementTree as ET
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+import preflight
+
+DEFAULT_CONTENT_ROUTING_CONFIG = {
+    "enabled": False,
+    "warehouse_property": "Склад",
+    "date_property": "ДатаДокумента",
+    "warehouse_cell": "",
+    "date_cell": "",
+    "workers": 4
+}
+
+# Ограничение размера кэша (старые записи удаляются первыми)
+MAX_CACHE_ENTRIES = 5000
+
+DATE_FORMATS = ('%Y%m%d', '%Y-%m-%d', '%d.%m.%Y', '%d.%m.%y', '%d/%m/%Y')
+
+
+def get_cache_path():
+    """Возвращает путь к кэшу результатов разбора книг."""
+    return os.path.join("logs", "content_routing_cache.json")
+
+
+def load_cache():
+    """Загружает кэш результатов разбора книг."""
+    return preflight.load_json(get_cache_path())
+
+
+def save_cache(cache):
+    """Сохраняет кэш результатов разбора книг."""
+    preflight.save_json(get_cache_path(), cache)
+
+
+def local_name(tag):
+    """Имя XML-тега без пространства имен."""
+    return tag.rsplit('}', 1)[-1]
+
+
+def read_properties(archive):
+    """Читает пользовательские и стандартные свойства книги: имя -> строка."""
+    properties = {}
+    names = set(archive.namelist())
+    if 'docProps/core.xml' in names:
+        with archive.open('docProps/core.xml') as f:
+            for element in ET.parse(f).getroot():
+                if element.text and element.text.strip():
+                    properties[local_name(element.tag)] = element.text.strip()
+    if 'docProps/custom.xml' in names:
+        with archive.open('docProps/custom.xml') as f:
+            for prop in ET.parse(f).getroot():
+                name = prop.get('name')
+                value = next((child.text for child in prop if child.text), None)
+                if name and value:
+                    properties[name] = value.strip()
+    return properties
+
+
+def split_cell(reference):
+    """Разбирает адрес ячейки 'B12' на ('B', 12)."""
+    match = re.fullmatch(r'([A-Za-z]+)(\d+)', reference.strip())
+    if not match:
+        raise ValueError(f"Неверный адрес ячейки: {reference}")
+    return match.group(1).upper(), int(match.group(2))
+
+
+def first_sheet_path(archive):
+    """Путь к первому листу книги внутри архива."""
+    rel_ns = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id'
+    with archive.open('xl/workbook.xml') as f:
+        sheet = next((el for el in ET.parse(f).getroot().iter() if local_name(el.tag) == 'sheet'), None)
+    if sheet is not None and sheet.get(rel_ns) and 'xl/_rels/workbook.xml.rels' in archive.namelist():
+        with archive.open('xl/_rels/workbook.xml.rels') as f:
+            for rel in ET.parse(f).getroot():
+                if rel.get('Id') == sheet.get(rel_ns):
+                    target = rel.get('Target')
+                    return target.lstrip('/') if target.startswith('/') else posixpath.normpath(posixpath.join('xl', target))
+    return 'xl/worksheets/sheet1.xml'
+
+
+def shared_strings(archive, indexes):
+    """Потоково читает из sharedStrings.xml только строки с нужными индексами."""
+    result = {}
+    if not indexes or 'xl/sharedStrings.xml' not in archive.namelist():
+        return result
+    last = max(indexes)
+    with archive.open('xl/sharedStrings.xml') as f:
+        position = 0
+        for _, element in ET.iterparse(f):
+            if local_name(element.tag) == 'si':
+                if position in indexes:
+                    result[position] = ''.join(t.text or '' for t in element.iter() if local_name(t.tag) == 't')
+                element.clear()
+                if position >= last:
+                    break
+                position += 1
+    return result
+
+
+def read_cells(archive, references):
+    """Потоково читает значения ячеек первого листа, останавливаясь после нужной строки."""
+    wanted = {ref.upper() for ref in references if ref}
+    if not wanted:
+        return {}
+    last_row = max(split_cell(ref)[1] for ref in wanted)
+    raw = {}
+    with archive.open(first_sheet_path(archive)) as f:
+        for _, element in ET.iterparse(f):
+            tag = local_name(element.tag)
+            if tag == 'c' and element.get('r', '').upper() in wanted:
+                value = None
+                if element.get('t') == 'inlineStr':
+                    value = ''.join(t.text or '' for t in element.iter() if local_name(t.tag) == 't')
+                else:
+                    v = next((child for child in element if local_name(child.tag) == 'v'), None)
+                    value = v.text if v is not None else None
+                raw[element.get('r').upper()] = (element.get('t'), value)
+            elif tag == 'row':
+                element.clear()
+                if int(element.get('r', 0) or 0) >= last_row or len(raw) == len(wanted):
+                    break
+    indexes = {int(value) for cell_type, value in raw.values() if cell_type == 's' and value is not None}
+    strings = shared_strings(archive, indexes)
+    cells = {}
+    for reference, (cell_type, value) in raw.items():
+        if cell_type == 's' and value is not None:
+            value = strings.get(int(value))
+        cells[reference] = value.strip() if isinstance(value, str) else value
+    return cells
+
+
+def parse_document_date(value):
+    """Преобразует значение свойства или ячейки в строку ГГГГММДД (None, если не дата)."""
+    if not value:
+        return None
+    value = str(value).strip()
+    # Число - порядковый номер даты Excel
+    if re.fullmatch(r'\d{5}(\.\d+)?', value):
+        return (datetime(1899, 12, 30) + timedelta(days=int(float(value)))).strftime('%Y%m%d')
+    # Дата-время из свойств книги: 2025-08-14T00:00:00Z
+    if re.match(r'\d{4}-\d{2}-\d{2}T', value):
+        return value[:10].replace('-', '')
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format).strftime('%Y%m%d')
+        except ValueError:
+            continue
+    return None
+
+
+def extract_route(path, routing_config):
+    """
+    Определяет склад и дату документа книги.
+    Возвращает {'warehouse': код или None, 'date': ГГГГММДД или None, 'error': текст или None}.
+    """
+    route = {'warehouse': None, 'date': None, 'error': None}
+    try:
+        with zipfile.ZipFile(path) as archive:
+            properties = read_properties(archive)
+            route['warehouse'] = properties.get(routing_config.get('warehouse_property') or '')
+            route['date'] = parse_document_date(properties.get(routing_config.get('date_property') or ''))
+            missing_cells = []
+            if not route['warehouse'] and routing_config.get('warehouse_cell'):
+                missing_cells.append(routing_config['warehouse_cell'])
+            if not route['date'] and routing_config.get('date_cell'):
+                missing_cells.append(routing_config['date_cell'])
+            if missing_cells:
+                cells = read_cells(archive, missing_cells)
+                if not route['warehouse'] and routing_config.get('warehouse_cell'):
+                    value = cells.get(routing_config['warehouse_cell'].upper())
+                    route['warehouse'] = str(value).strip() if value else None
+                if not route['date'] and routing_config.get('date_cell'):
+                    route['date'] = parse_document_date(cells.get(routing_config['date_cell'].upper()))
+    except Exception as e:
+        # Любая ошибка разбора (в том числе zlib.error поврежденного сжатого потока)
+        # относится только к этому файлу: она кэшируется и не мешает остальным
+        route['error'] = f"{type(e).__name__}: {e}"
+    # Код склада в числовой ячейке читается как "7210.0"
+    if route['warehouse'] and re.fullmatch(r'\d+\.0', route['warehouse']):
+        route['warehouse'] = route['warehouse'][:-2]
+    return route
+
+
+def route_files(folder_path, file_names, config):
+    """
+    Определяет склад и дату для файлов, не подходящих под правило имени.
+    Возвращает словарь имя файла -> (код склада, ГГГГММДД) только для файлов,
+    у которых найдены оба значения. Пустой словарь, если маршрутизация выключена.
+    """
+    routing_config = dict(DEFAULT_CONTENT_ROUTING_CONFIG)
+    routing_config.update(config.get('content_routing', {}))
+    if not routing_config.get('enabled') or not file_names:
+        return {}
+
+    cache = load_cache()
+    routes = {}
+    to_parse = []
+    for name in file_names:
+        try:
+            st = os.stat(os.path.join(folder_path, name))
+        except OSError:
+            continue
+        fingerprint = f"{st.st_size}:{st.st_mtime_ns}"
+        cached = cache.get(name)
+        if cached and cached.get('fingerprint') == fingerprint:
+            routes[name] = cached
+        else:
+            to_parse.append((name, fingerprint))
+
+    if to_parse:
+        workers = max(1, min(int(routing_config.get('workers', 4)), len(to_parse)))
+        paths = [os.path.join(folder_path, name) for name, _ in to_parse]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            parsed = list(executor.map(lambda p: extract_route(p, routing_config), paths))
+        parsed_at = datetime.now().isoformat(timespec='seconds')
+        for (name, fingerprint), route in zip(to_parse, parsed):
+            route.update(fingerprint=fingerprint, parsed_at=parsed_at)
+            cache[name] = route
+            routes[name] = route
+            if route['error']:
+                logging.warning(f"Маршрутизация по содержимому: не удалось прочитать {name}: {route['error']}")
+            elif route['warehouse'] and route['date']:
+                logging.info(f"Маршрутизация по содержимому: {name} -> склад {route['warehouse']}, дата {route['date']}")
+            else:
+                logging.debug(f"Маршрутизация по содержимому: в {name} нет склада или даты")
+        if len(cache) > MAX_CACHE_ENTRIES:
+            oldest = sorted(cache, key=lambda n: cache[n].get('parsed_at', ''))
+            for name in oldest[:len(cache) - MAX_CACHE_ENTRIES]:
+                del cache[name]
+        save_cache(cache)
+
+    return {
+        name: (route['warehouse'], route['date'])
+        for name, route in routes.items()
+        if route.get('warehouse') and route.get('date')
+    }
@@ -0,0 +1,137 @@
+"""
+Заранее собранные письма для ближайших дней отправки.
+
+Из-за days_offset и send_on_friday файлы часто лежат в папке за день и больше до
+дня отправки. Сервис заранее собирает для них полные письма (получатель, тема,
+текст, вложения) и сохраняет их в черновиках Outlook. В день отправки остается
+только вызвать Send() у готового черновика, поэтому утренняя отправка по всем
+складам занимает секунды.
+
+Манифест logs/prebuilt.json: ключ "ГГГГММДД:склад" -> {entry_id, send_date,
+warehouse, signature, built_at}. signature - получатель, тема и отпечатки файлов
+(размер + время изменения). Если входные данные изменились, черновик удаляется
+и собирается заново; при несовпадении в день отправки письмо собирается обычным способом.
+
+    "prebuild": {"enabled": true, "lookahead_days": 3}
+"""
+import os
+import logging
+from datetime import datetime
+
+import preflight
+
+DEFAULT_PREBUILD_CONFIG = {
+    "enabled": False,
+    "lookahead_days": 3
+}
+
+
+def get_prebuild_config(config):
+    """Возвращает настройки prebuild с подставленными значениями по умолчанию."""
+    prebuild_config = dict(DEFAULT_PREBUILD_CONFIG)
+    prebuild_config.update(config.get('prebuild', {}))
+    return prebuild_config
+
+
+def get_manifest_path():
+    """Возвращает путь к манифесту заранее собранных писем."""
+    return os.path.join("logs", "prebuilt.json")
+
+
+def load_manifest():
+    """Загружает манифест заранее собранных писем."""
+    return preflight.load_json(get_manifest_path())
+
+
+def save_manifest(manifest):
+    """Сохраняет манифест заранее собранных писем."""
+    preflight.save_json(get_manifest_path(), manifest)
+
+
+def message_key(day, warehouse_code):
+    """Ключ письма в манифесте: день отправки и склад."""
+    return f"{day.strftime('%Y%m%d')}:{warehouse_code}"
+
+
+def signature(folder_path, data, subject):
+    """Входные данные письма: получатель, тема и отпечатки файлов."""
+    files = {}
+    for name in data['files']:
+        try:
+            st = os.stat(os.path.join(folder_path, name))
+            files[name] = f"{st.st_size}:{st.st_mtime_ns}"
+        except OSError:
+            files[name] = None
+    return {'email': data['email'], 'subject': subject, 'files': files}
+
+
+def build_draft(outlook, to_email, subject, body, attachment_paths):
+    """Собирает письмо и сохраняет его в черновиках. Возвращает EntryID или None."""
+    try:
+        mail = outlook.CreateItem(0)
+        mail.To = to_email
+        mail.Subject = subject
+        mail.Body = body
+        for path in attachment_paths:
+            mail.Attachments.Add(path)
+        mail.Save()
+        return mail.EntryID
+    except Exception as e:
+        logging.error(f"Ошибка сборки письма заранее ({subject}): {e}")
+        return None
+
+
+def discard(outlook, entry):
+    """Удаляет черновик заранее собранного письма."""
+    try:
+        outlook.Session.GetItemFromID(entry['entry_id']).Delete()
+    except Exception as e:
+        logging.debug(f"Черновик {entry.get('entry_id')} уже удален или недоступен: {e}")
+
+
+def find_ready(manifest, day, warehouse_code, current_signature):
+    """Возвращает запись готового письма, если его входные данные не изменились."""
+    entry = manifest.get(message_key(day, warehouse_code))
+    if entry and entry.get('entry_id') and entry.get('signature') == current_signature:
+        return entry
+    return None
+
+
+def sync(outlook_factory, manifest, wanted, today):
+    """
+    Приводит черновики в соответствие с нужными письмами.
+    wanted - словарь ключ -> {'day', 'warehouse', 'signature', 'body', 'paths'}.
+    Черновики прошедших дней и письма с изменившимися данными удаляются,
+    новые и изменившиеся письма собираются. Outlook подключается, только если
+    есть что менять. Возвращает True, если манифест изменился.
+    """
+    today_str = today.strftime('%Y%m%d')
+    stale = [key for key, entry in manifest.items()
+             if key not in wanted and entry.get('send_date') != today_str]
+    todo = [key for key, item in wanted.items()
+            if manifest.get(key, {}).get('signature') != item['signature']]
+    if not stale and not todo:
+        return False
+
+    outlook = outlook_factory()
+    if not outlook:
+        logging.error("Не удалось подключиться к Outlook для сборки писем заранее.")
+        return False
+
+    for key in stale:
+        discard(outlook, manifest.pop(key))
+    for key in todo:
+        item = wanted[key]
+        if key in manifest:
+            discard(outlook, manifest.pop(key))
+        entry_id = build_draft(outlook, item['signature']['email'], item['signature']['subject'], item['body'], item['paths'])
+        if entry_id:
+            manifest[key] = {
+                'entry_id': entry_id,
+                'send_date': item['day'].strftime('%Y%m%d'),
+                'warehouse': item['warehouse'],
+                'signature': item['signature'],
+                'built_at': datetime.now().isoformat(timespec='seconds')
+            }
+            logging.info(f"Письмо склада {item['warehouse']} на {item['day'].strftime('%d.%m.%Y')} собрано заранее ({len(item['paths'])} файлов)")
+    return True
@@ -0,0 +1,186 @@
+"""
+Предварительная проверка вложений перед отправкой.
+
+Каждый файл проверяется один раз для своего отпечатка (размер + время изменения):
+файл читается, не пустой, имеет правдоподобный размер и корректный центральный
+каталог ZIP (.xlsx - это ZIP-архив). Проверки выполняются пулом потоков, вердикты
+кэшируются в logs/preflight_cache.json. Неисправные файлы попадают в карантин
+(logs/quarantine.json), остальные файлы группы отправляются как обычно.
+"""
+import os
+import json
+import logging
+import zipfile
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import checkpoint
+
+DEFAULT_PREFLIGHT_CONFIG = {
+    "enabled": True,
+    "workers": 4,
+    "min_size_kb": 1,
+    "max_size_mb": 50
+}
+
+# Ограничение размера кэша вердиктов (старые записи удаляются первыми)
+MAX_CACHE_ENTRIES = 5000
+
+
+def get_cache_path():
+    """Возвращает путь к кэшу вердиктов проверки."""
+    return os.path.join("logs", "preflight_cache.json")
+
+
+def get_quarantine_path():
+    """Возвращает путь к списку файлов в карантине."""
+    return os.path.join("logs", "quarantine.json")
+
+
+def load_json(path, expected_type=dict):
+    """
+    Загружает JSON-файл состояния. Возвращает значение типа expected_type
+    (по умолчанию словарь); пустое значение, если файла нет или он поврежден.
+    Используется всеми модулями, хранящими состояние в logs/.
+    """
+    if not os.path.exists(path):
+        return expected_type()
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+            return data if isinstance(data, expected_type) else expected_type()
+    except Exception as e:
+        logging.error(f"Ошибка загрузки {path}: {e}")
+        return expected_type()
+
+
+def save_json(path, data):
+    """Атомарно сохраняет JSON-файл состояния (ошибка записи только пишется в лог)."""
+    try:
+        checkpoint.write_json(path, data)
+    except Exception as e:
+        logging.error(f"Ошибка сохранения {path}: {e}")
+
+
+def load_quarantine():
+    """Возвращает словарь файлов в карантине: имя -> {reason, fingerprint, detected_at}."""
+    return load_json(get_quarantine_path())
+
+
+def file_fingerprint(path):
+    """Отпечаток файла: размер и время изменения. None, если файл недоступен."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return f"{st.st_size}:{st.st_mtime_ns}"
+
+
+def check_file(path, preflight_config):
+    """
+    Проверяет один файл. Возвращает (True, None) для исправного файла
+    или (False, причина) для неисправного.
+    """
+    try:
+        size = os.path.getsize(path)
+    except OSError as e:
+        return False, f"Файл недоступен: {e}"
+    if size == 0:
+        return False, "Пустой файл"
+    min_size = preflight_config.get('min_size_kb', 0) * 1024
+    max_size = preflight_config.get('max_size_mb', 0) * 1024 * 1024
+    if min_size and size < min_size:
+        return False, f"Слишком маленький файл: {size} байт"
+    if max_size and size > max_size:
+        return False, f"Слишком большой файл: {size} байт"
+    try:
+        # ZipFile читает центральный каталог; у недописанного файла его нет
+        with zipfile.ZipFile(path) as archive:
+            names = archive.namelist()
+    except zipfile.BadZipFile:
+        return False, "Поврежден или не дописан ZIP (нет центрального каталога)"
+    except OSError as e:
+        return False, f"Ошибка чтения файла: {e}"
+    if '[Content_Types].xml' not in names:
+        return False, "Архив не является книгой Excel (нет [Content_Types].xml)"
+    return True, None
+
+
+def run_preflight(folder_path, files_to_send, config, paths=None):
+    """
+    Проверяет вложения всех групп перед отправкой.
+    files_to_send - словарь вида результата select_new_files.
+    paths - необязательный словарь имя файла -> путь (например, локальные копии staging),
+    по которому читается содержимое; для остальных файлов используется folder_path.
+    Отпечаток для кэша и карантина всегда берется у исходного файла в folder_path.
+    Возвращает словарь того же вида только с исправными файлами;
+    склады, у которых не осталось файлов, исключаются.
+    """
+    preflight_config = dict(DEFAULT_PREFLIGHT_CONFIG)
+    preflight_config.update(config.get('preflight', {}))
+    if not preflight_config.get('enabled', True):
+        return files_to_send
+
+    cache = load_json(get_cache_path())
+    quarantine = load_quarantine()
+    try:
+        present = set(checkpoint.list_folder(folder_path))
+    except OSError:
+        present = None
+    # Файлы, которых уже нет в папке, убираем из карантина
+    missing = [name for name in quarantine if present is not None and name not in present]
+    for name in missing:
+        del quarantine[name]
+    quarantine_changed = bool(missing)
+    paths = paths or {}
+    verdicts = {}
+    to_check = []
+    for data in files_to_send.values():
+        for file in data['files']:
+            fingerprint = file_fingerprint(os.path.join(folder_path, file))
+            cached = cache.get(file)
+            if fingerprint and cached and cached.get('fingerprint') == fingerprint:
+                verdicts[file] = (cached['ok'], cached.get('reason'))
+            else:
+                to_check.append((file, fingerprint))
+
+    if to_check:
+        workers = max(1, min(int(preflight_config.get('workers', 4)), len(to_check)))
+        check_paths = [paths.get(file) or os.path.join(folder_path, file) for file, _ in to_check]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            checked = list(executor.map(lambda p: check_file(p, preflight_config), check_paths))
+        checked_at = datetime.now().isoformat(timespec='seconds')
+        for (file, fingerprint), (ok, reason) in zip(to_check, checked):
+            verdicts[file] = (ok, reason)
+            if fingerprint:
+                cache[file] = {'fingerprint': fingerprint, 'ok': ok, 'reason': reason, 'checked_at': checked_at}
+            if not ok and file not in quarantine:
+                quarantine[file] = {'reason': reason, 'fingerprint': fingerprint, 'detected_at': checked_at}
+                quarantine_changed = True
+                logging.warning(f"Файл {file} помещен в карантин: {reason}")
+            elif ok and file in quarantine:
+                del quarantine[file]
+                quarantine_changed = True
+                logging.info(f"Файл {file} исправен и удален из карантина")
+        # Вердикты файлов, которых уже нет в папке, больше не нужны
+        if present is not None:
+            for name in [name for name in cache if name not in present]:
+                del cache[name]
+        if len(cache) > MAX_CACHE_ENTRIES:
+            oldest = sorted(cache, key=lambda name: cache[name].get('checked_at', ''))
+            for name in oldest[:len(cache) - MAX_CACHE_ENTRIES]:
+                del cache[name]
+        save_json(get_cache_path(), cache)
+        logging.info(f"Предварительная проверка: проверено {len(to_check)} файлов, из кэша {len(verdicts) - len(to_check)}")
+    if quarantine_changed:
+        save_json(get_quarantine_path(), quarantine)
+
+    valid_files = {}
+    for warehouse_code, data in files_to_send.items():
+        good = [f for f in data['files'] if verdicts[f][0]]
+        if good:
+            valid_files[warehouse_code] = dict(data, files=good)
+        skipped = len(data['files']) - len(good)
+        if skipped:
+            logging.info(f"Склад {warehouse_code}: {skipped} файлов в карантине не будут отправлены")
+    return valid_files
@@ -0,0 +1,202 @@
+"""
+Профилирование циклов сервиса отправки.
+
+Включается в config.json (раздел "profiling") или переключателем на странице "Логи".
+Для каждого цикла monitor_and_send записываются длительности этапов (чтение
+конфигурации, listdir, сопоставление файлов, журнал отправленных, подключение
+к Outlook, сборка письма, mail.Send() и т.д.) в logs/profiles/cycles.json.
+Этапы просмотра папки наперед записываются отдельно с префиксом "look_ahead."
+(look_ahead.listdir, look_ahead.match и т.д.), чтобы не смешиваться с этапами отправки.
+Дополнительно для N самых медленных циклов можно сохранять профиль cProfile
+(.prof) и снимок памяти tracemalloc (.txt) в logs/profiles/.
+"""
+import os
+import time
+import logging
+from contextlib import contextmanager
+from datetime import datetime
+
+import preflight
+
+DEFAULT_PROFILING_CONFIG = {
+    "enabled": False,
+    "slowest_cycles": 5,
+    "cprofile": False,
+    "tracemalloc": False
+}
+
+# Сколько последних циклов хранится в cycles.json
+MAX_RECORDED_CYCLES = 500
+
+# Профиль текущего цикла (None, если профилирование выключено)
+_current = None
+
+
+def get_profiles_dir():
+    """Возвращает папку для результатов профилирования."""
+    return os.path.join("logs", "profiles")
+
+
+def get_cycles_path():
+    """Возвращает путь к журналу длительностей этапов."""
+    return os.path.join(get_profiles_dir(), "cycles.json")
+
+
+def get_slowest_path():
+    """Возвращает путь к списку самых медленных циклов."""
+    return os.path.join(get_profiles_dir(), "slowest.json")
+
+
+def start_cycle(config, started=None):
+    """
+    Начинает профилирование цикла, если оно включено в config.
+    started - значение time.perf_counter() в начале цикла (по умолчанию - сейчас);
+    время от started до вызова записывается как этап "load_config".
+    """
+    global _current
+    _current = None
+    profiling_config = dict(DEFAULT_PROFILING_CONFIG)
+    profiling_config.update(config.get('profiling', {}))
+    if not profiling_config.get('enabled'):
+        return
+
+    now_counter = time.perf_counter()
+    started = started if started is not None else now_counter
+    _current = {
+        'config': profiling_config,
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'started': started,
+        'spans': {'load_config': now_counter - started},
+        'prefix': '',
+        'profiler': None
+    }
+    if profiling_config.get('tracemalloc'):
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+    if profiling_config.get('cprofile'):
+        import cProfile
+        _current['profiler'] = cProfile.Profile()
+        _current['profiler'].enable()
+
+
+@contextmanager
+def span(name, nested=False):
+    """
+    Замеряет длительность этапа цикла. Вне профилируемого цикла ничего не делает.
+    nested=True - этапы внутри записываются под своими именами с префиксом "name."
+    (например, look_ahead.listdir), а не складываются с одноименными этапами цикла.
+    """
+    if _current is None:
+        yield
+        return
+    outer_prefix = _current['prefix']
+    full_name = outer_prefix + name
+    if nested:
+        _current['prefix'] = full_name + '.'
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        # Если профилирование выключили внутри цикла, этап уже некуда записать
+        if _current is not None:
+            _current['prefix'] = outer_prefix
+            spans = _current['spans']
+            spans[full_name] = spans.get(full_name, 0.0) + time.perf_counter() - started
+
+
+def finish_cycle():
+    """Завершает профилирование цикла и сохраняет результаты."""
+    global _current
+    cycle = _current
+    _current = None
+    if cycle is None:
+        return
+
+    total = time.perf_counter() - cycle['started']
+    profiler = cycle['profiler']
+    if profiler is not None:
+        profiler.disable()
+    snapshot = None
+    if cycle['config'].get('tracemalloc'):
+        import tracemalloc
+        if tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+
+    record = {
+        'started_at': cycle['started_at'],
+        'total_ms': round(total * 1000, 3),
+        'spans': {name: round(value * 1000, 3) for name, value in cycle['spans'].items()}
+    }
+    try:
+        cycles = preflight.load_json(get_cycles_path(), list)
+        cycles.append(record)
+        preflight.save_json(get_cycles_path(), cycles[-MAX_RECORDED_CYCLES:])
+        keep_if_slowest(record, cycle['config'], profiler, snapshot)
+    except Exception as e:
+        logging.error(f"Ошибка сохранения результатов профилирования: {e}")
+
+
+def keep_if_slowest(record, profiling_config, profiler, snapshot):
+    """Сохраняет cProfile и tracemalloc цикла, если он входит в N самых медленных."""
+    if profiler is None and snapshot is None:
+        return
+    limit = int(profiling_config.get('slowest_cycles', 5))
+    slowest = preflight.load_json(get_slowest_path(), list)
+    if len(slowest) >= limit and slowest and record['total_ms'] <= slowest[-1]['total_ms']:
+        return
+
+    profiles_dir = get_profiles_dir()
+    os.makedirs(profiles_dir, exist_ok=True)
+    base_name = "cycle_" + datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+    entry = dict(record)
+    if profiler is not None:
+        entry['cprofile_file'] = base_name + ".prof"
+        profiler.dump_stats(os.path.join(profiles_dir, entry['cprofile_file']))
+    if snapshot is not None:
+        entry['tracemalloc_file'] = base_name + "_memory.txt"
+        with open(os.path.join(profiles_dir, entry['tracemalloc_file']), 'w', encoding='utf-8') as f:
+            for stat in snapshot.statistics('lineno')[:30]:
+                f.write(f"{stat}\n")
+
+    slowest.append(entry)
+    slowest.sort(key=lambda item: item['total_ms'], reverse=True)
+    for evicted in slowest[limit:]:
+        for key in ('cprofile_file', 'tracemalloc_file'):
+            if evicted.get(key):
+                try:
+                    os.remove(os.path.join(profiles_dir, evicted[key]))
+                except OSError:
+                    pass
+    preflight.save_json(get_slowest_path(), slowest[:limit])
+
+
+def summarize_spans(cycles=None):
+    """
+    Сводка по этапам за записанные циклы: для каждого этапа количество,
+    среднее, p95 и максимум в миллисекундах. Отсортирована по максимуму.
+    """
+    if cycles is None:
+        cycles = preflight.load_json(get_cycles_path(), list)
+    values = {}
+    for record in cycles:
+        for name, ms in record.get('spans', {}).items():
+            values.setdefault(name, []).append(ms)
+    summary = []
+    for name, samples in values.items():
+        samples.sort()
+        summary.append({
+            'span': name,
+            'count': len(samples),
+            'mean_ms': round(sum(samples) / len(samples), 3),
+            'p95_ms': samples[max(0, int(len(samples) * 0.95) - 1)],
+            'max_ms': samples[-1]
+        })
+    summary.sort(key=lambda item: item['max_ms'], reverse=True)
+    return summary
+
+
+def load_slowest_cycles():
+    """Возвращает список самых медленных циклов с сохраненными профилями."""
+    return preflight.load_json(get_slowest_path(), list)
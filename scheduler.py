@@ -0,0 +1,153 @@
+"""
+Порядок отправки писем по срокам доставки складов.
+
+Каждый склад в date_config может иметь приоритет и срок доставки:
+    "7210": {"days_offset": 1, "send_on_friday": 3, "priority": 1, "deadline": "10:00"}
+priority - меньшее число важнее, deadline - время ЧЧ:ММ, до которого письмо должно уйти
+в день отправки. Если они не заданы, они выводятся из days_offset/send_on_friday:
+срок - конец дня накануне даты документов (но не раньше конца дня отправки),
+приоритет - 100 + число дней до даты документов. Поэтому склад с days_offset 1
+уходит раньше склада с days_offset 2.
+
+Если писем больше, чем разрешено отправить за цикл (dispatch.max_sends_per_cycle),
+сначала уходят письма с ближайшим сроком, затем по приоритету. Защита от голодания:
+склад, ожидающий дольше dispatch.starvation_minutes, отправляется в первую очередь.
+Опоздания считаются по складам в logs/dispatch_state.json: как опоздание учитывается
+и поздняя отправка, и склад, который к сроку все еще ждет в очереди.
+"""
+import os
+import logging
+from datetime import datetime, timedelta
+
+import preflight
+
+DEFAULT_DISPATCH_CONFIG = {
+    "max_sends_per_cycle": 0,
+    "starvation_minutes": 120
+}
+
+DEFAULT_PRIORITY = 100
+DEFAULT_DEADLINE = "23:59"
+
+
+def get_state_path():
+    """Возвращает путь к состоянию диспетчера (ожидание и метрики сроков)."""
+    return os.path.join("logs", "dispatch_state.json")
+
+
+def load_state():
+    """Загружает состояние диспетчера: {'waiting': {...}, 'overdue': {...}, 'metrics': {...}}."""
+    data = preflight.load_json(get_state_path())
+    return {
+        'waiting': data.get('waiting', {}),
+        'overdue': data.get('overdue', {}),
+        'metrics': data.get('metrics', {})
+    }
+
+
+def save_state(state):
+    """Сохраняет состояние диспетчера."""
+    preflight.save_json(get_state_path(), state)
+
+
+def lead_days(date_info, moment):
+    """Через сколько дней после дня отправки наступает дата документов склада."""
+    days_offset = date_info.get('days_offset', 0)
+    if moment.weekday() == 4:  # Пятница
+        days_offset = date_info.get('send_on_friday', days_offset)
+    return days_offset
+
+
+def get_priority(date_info, moment):
+    """Приоритет склада: заданный или 100 + число дней до даты документов."""
+    priority = date_info.get('priority')
+    if priority is None:
+        return DEFAULT_PRIORITY + lead_days(date_info, moment)
+    return priority
+
+
+def get_deadline(date_info, moment):
+    """
+    Срок доставки склада в день moment: заданное время ЧЧ:ММ или, если срок не задан,
+    конец дня накануне даты документов (не раньше конца дня отправки).
+    """
+    day = moment.date()
+    deadline_str = date_info.get('deadline')
+    if not deadline_str:
+        day += timedelta(days=max(lead_days(date_info, moment) - 1, 0))
+        deadline_str = DEFAULT_DEADLINE
+    try:
+        hours, minutes = deadline_str.split(':')
+        return datetime.combine(day, datetime.min.time()) + timedelta(hours=int(hours), minutes=int(minutes))
+    except ValueError:
+        logging.warning(f"Неверный срок доставки '{deadline_str}', используется {DEFAULT_DEADLINE}")
+        return datetime.combine(day, datetime.min.time()) + timedelta(hours=23, minutes=59)
+
+
+def count_missed(state, warehouse_code, deadline, moment):
+    """Учитывает опоздание склада (один раз на срок) и наибольшее опоздание в минутах."""
+    metrics = state['metrics'].setdefault(warehouse_code, {'sent': 0, 'missed': 0, 'max_late_minutes': 0})
+    late_minutes = round((moment - deadline).total_seconds() / 60, 1)
+    if state['overdue'].get(warehouse_code) != deadline.isoformat():
+        state['overdue'][warehouse_code] = deadline.isoformat()
+        metrics['missed'] += 1
+        metrics['last_missed'] = moment.isoformat(timespec='seconds')
+    metrics['max_late_minutes'] = max(metrics['max_late_minutes'], late_minutes)
+    return late_minutes
+
+
+def plan_dispatch(files_to_send, config, moment, state):
+    """
+    Определяет, какие склады отправлять в этом цикле и в каком порядке.
+    Возвращает список кодов складов. Склады, не вошедшие в лимит цикла,
+    остаются в state['waiting'] и получают преимущество в следующих циклах.
+    """
+    date_config = config.get('date_config', {})
+    dispatch_config = dict(DEFAULT_DISPATCH_CONFIG)
+    dispatch_config.update(config.get('dispatch', {}))
+    starvation = timedelta(minutes=dispatch_config.get('starvation_minutes', 0) or 0)
+
+    waiting = state['waiting']
+    # Склады, которых больше нет в очереди, перестают ждать
+    for pending in (waiting, state['overdue']):
+        for warehouse_code in list(pending):
+            if warehouse_code not in files_to_send:
+                del pending[warehouse_code]
+
+    # Склады, которые к сроку все еще в очереди, считаются опоздавшими
+    for warehouse_code in files_to_send:
+        deadline = get_deadline(date_config.get(warehouse_code, {}), moment)
+        if moment > deadline and state['overdue'].get(warehouse_code) != deadline.isoformat():
+            count_missed(state, warehouse_code, deadline, moment)
+            logging.warning(f"Склад {warehouse_code}: письмо не отправлено к сроку {deadline.strftime('%d.%m.%Y %H:%M')}")
+
+    def sort_key(warehouse_code):
+        date_info = date_config.get(warehouse_code, {})
+        first_seen = datetime.fromisoformat(waiting.setdefault(warehouse_code, moment.isoformat()))
+        starving = bool(starvation) and moment - first_seen >= starvation
+        return (
+            0 if starving else 1,
+            first_seen if starving else datetime.min,
+            get_deadline(date_info, moment),
+            get_priority(date_info, moment),
+            first_seen
+        )
+
+    order = sorted(files_to_send, key=sort_key)
+    limit = dispatch_config.get('max_sends_per_cycle', 0)
+    if limit and len(order) > limit:
+        logging.info(f"Очередь отправки: {len(order)} складов, в этом цикле будет отправлено {limit}: {', '.join(order[:limit])}")
+        order = order[:limit]
+    return order
+
+
+def record_send(state, warehouse_code, date_info, moment):
+    """Учитывает отправку склада: снимает его с ожидания и считает опоздание."""
+    state['waiting'].pop(warehouse_code, None)
+    deadline = get_deadline(date_info, moment)
+    metrics = state['metrics'].setdefault(warehouse_code, {'sent': 0, 'missed': 0, 'max_late_minutes': 0})
+    metrics['sent'] += 1
+    if moment > deadline:
+        late_minutes = count_missed(state, warehouse_code, deadline, moment)
+        logging.warning(f"Склад {warehouse_code}: письмо отправлено позже срока {deadline.strftime('%H:%M')} на {late_minutes} мин.")
+    state['overdue'].pop(warehouse_code, None)
@@ -0,0 +1,239 @@
+"""
+Командная строка для ручной работы с рассылкой без Streamlit и браузера.
+
+Использует ту же логику, что и sender_service.py, и выводит результат в JSON.
+Тяжелые зависимости (win32com, psutil) импортируются только в тех командах,
+которым они нужны, поэтому запуск занимает доли секунды.
+
+Примеры:
+    python -m sender_cli preview
+    python -m sender_cli preview --date 2025-08-15
+    python -m sender_cli send-now
+    python -m sender_cli backfill --from 2025-08-11 --to 2025-08-15
+    python -m sender_cli status
+    python -m sender_cli dedupe-check
+"""
+import os
+import sys
+import json
+import argparse
+from datetime import datetime, timedelta
+
+import scheduler
+import sender_pool
+import sender_service
+
+
+def parse_date(value):
+    """Преобразует строку ГГГГ-ММ-ДД в datetime с текущим временем суток."""
+    day = datetime.strptime(value, '%Y-%m-%d')
+    return datetime.combine(day.date(), datetime.now().time())
+
+
+def use_date(value):
+    """Переводит часы сервиса на указанную дату (None - системные часы)."""
+    if value:
+        moment = parse_date(value)
+        sender_service.set_clock(lambda: moment)
+    else:
+        sender_service.set_clock(None)
+
+
+def grouped_files_now(config):
+    """Возвращает файлы по складам для текущей даты часов сервиса."""
+    return sender_service.get_files_for_sending(config['folder_path'], config)
+
+
+def cmd_preview(args):
+    """Файлы, подходящие по date_config, с отметкой об отправке."""
+    use_date(args.date)
+    config = sender_service.load_config()
+    grouped_files = grouped_files_now(config)
+    sent_files = sender_service.load_sent_files()
+    return {
+        'date': sender_service.now().date().isoformat(),
+        'weekend': sender_service.now().weekday() in [5, 6],
+        'folder_path': config['folder_path'],
+        'warehouses': {
+            warehouse_code: {
+                'email': data['email'],
+                'files': [{'name': f, 'sent': f in sent_files} for f in data['files']]
+            }
+            for warehouse_code, data in grouped_files.items()
+        }
+    }
+
+
+def ensure_service_stopped():
+    """Запрещает ручную отправку, пока работает сервис (он отправляет те же файлы)."""
+    pids = service_pids()
+    if pids:
+        raise ValueError(f"Сервис отправки запущен (PID {', '.join(map(str, pids))}). Остановите его перед ручной отправкой.")
+
+
+def run_cycle(manual_date=False):
+    """
+    Один цикл отправки сервиса; ошибка, если цикл уже выполняет другой процесс
+    или не удалось подключиться к Outlook. manual_date - часы переведены на дату
+    из командной строки (см. sender_service.monitor_and_send).
+    """
+    try:
+        results = sender_service.monitor_and_send(manual_date=manual_date)
+    except sender_service.TransportUnavailableError as e:
+        raise ValueError(f"{e}. Письма не отправлены.")
+    if results is None:
+        raise ValueError("Цикл отправки уже выполняется другим процессом.")
+    return results
+
+
+def cmd_send_now(args):
+    """Один цикл отправки сервиса (уже отправленные файлы пропускаются)."""
+    ensure_service_stopped()
+    use_date(args.date)
+    results = run_cycle(manual_date=bool(args.date))
+    return {
+        'date': sender_service.now().date().isoformat(),
+        'sent': sum(1 for r in results if r['success']),
+        'failed': sum(1 for r in results if not r['success']),
+        'results': results
+    }
+
+
+def cmd_backfill(args):
+    """Досылает неотправленные файлы, как если бы сервис работал в каждый из дней периода."""
+    ensure_service_stopped()
+    start = parse_date(args.date_from)
+    end = parse_date(args.date_to) if args.date_to else start
+    days = []
+    day = start
+    while day <= end:
+        moment = day
+        sender_service.set_clock(lambda: moment)
+        try:
+            results = run_cycle(manual_date=True)
+        finally:
+            sender_service.set_clock(None)
+        days.append({'date': day.date().isoformat(), 'results': results})
+        day += timedelta(days=1)
+    sender_service.set_clock(None)
+    return {
+        'from': start.date().isoformat(),
+        'to': end.date().isoformat(),
+        'sent': sum(1 for d in days for r in d['results'] if r['success']),
+        'failed': sum(1 for d in days for r in d['results'] if not r['success']),
+        'days': days
+    }
+
+
+def read_last_lines(path, count, block_size=8192):
+    """Читает последние count строк файла, не загружая его целиком."""
+    if not os.path.exists(path):
+        return []
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(0, size - block_size * count))
+        tail = f.read().decode('utf-8', errors='replace')
+    return [line for line in tail.splitlines() if line.strip()][-count:]
+
+
+def service_pids():
+    """Возвращает PID процессов sender_service.py (None, если psutil недоступен)."""
+    try:
+        import psutil
+    except ImportError:
+        return None
+    pids = []
+    for proc in psutil.process_iter(['pid', 'cmdline']):
+        try:
+            if proc.info['cmdline'] and 'sender_service.py' in ' '.join(proc.info['cmdline']):
+                pids.append(proc.info['pid'])
+        except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+            pass
+    return pids
+
+
+def cmd_status(args):
+    """Состояние сервиса, конфигурации и журнала отправленных файлов."""
+    config = sender_service.load_config()
+    pids = service_pids()
+    return {
+        'service_running': bool(pids) if pids is not None else None,
+        'service_pids': pids,
+        'folder_path': config['folder_path'],
+        'folder_exists': os.path.exists(config['folder_path']),
+        'warehouses': sorted(config.get('date_config', {})),
+        'sent_files_count': len(sender_service.load_sent_files()),
+        'deadlines': scheduler.load_state()['metrics'],
+        'sender_pool': sender_pool.load_state()['accounts'] if sender_pool.get_pool_config(config) else None,
+        'last_service_log': read_last_lines(os.path.join('logs', 'service.log'), args.lines)
+    }
+
+
+def cmd_dedupe_check(args):
+    """Какие из подходящих файлов уже есть в журнале отправленных, а какие новые."""
+    use_date(args.date)
+    config = sender_service.load_config()
+    grouped_files = grouped_files_now(config)
+    sent_files = sender_service.load_sent_files()
+    new_files = sender_service.select_new_files(grouped_files, sent_files)
+    warehouses = {}
+    for warehouse_code, data in grouped_files.items():
+        new = new_files.get(warehouse_code, {}).get('files', [])
+        warehouses[warehouse_code] = {
+            'email': data['email'],
+            'new': new,
+            'already_sent': [f for f in data['files'] if f not in new]
+        }
+    return {
+        'date': sender_service.now().date().isoformat(),
+        'new_count': sum(len(w['new']) for w in warehouses.values()),
+        'already_sent_count': sum(len(w['already_sent']) for w in warehouses.values()),
+        'warehouses': warehouses
+    }
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m sender_cli", description="Ручная работа с рассылкой файлов")
+    parser.add_argument("--verbose", action="store_true", help="Выводить лог в консоль (stderr)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    preview = subparsers.add_parser("preview", help="Показать файлы для отправки")
+    preview.add_argument("--date", help="Дата ГГГГ-ММ-ДД вместо сегодняшней")
+    preview.set_defaults(handler=cmd_preview)
+
+    send_now = subparsers.add_parser("send-now", help="Отправить новые файлы сейчас")
+    send_now.add_argument("--date", help="Дата ГГГГ-ММ-ДД вместо сегодняшней")
+    send_now.set_defaults(handler=cmd_send_now)
+
+    backfill = subparsers.add_parser("backfill", help="Дослать неотправленные файлы за период")
+    backfill.add_argument("--from", dest="date_from", required=True, help="Первый день ГГГГ-ММ-ДД")
+    backfill.add_argument("--to", dest="date_to", help="Последний день ГГГГ-ММ-ДД (по умолчанию равен --from)")
+    backfill.set_defaults(handler=cmd_backfill)
+
+    status = subparsers.add_parser("status", help="Состояние сервиса")
+    status.add_argument("--lines", type=int, default=5, help="Сколько последних строк service.log показать")
+    status.set_defaults(handler=cmd_status)
+
+    dedupe = subparsers.add_parser("dedupe-check", help="Проверить файлы по журналу отправленных")
+    dedupe.add_argument("--date", help="Дата ГГГГ-ММ-ДД вместо сегодняшней")
+    dedupe.set_defaults(handler=cmd_dedupe_check)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    sender_service.setup_logging('logs/cli.log', console=args.verbose)
+    try:
+        result = args.handler(args)
+    except ValueError as e:
+        json.dump({'error': str(e)}, sys.stdout, ensure_ascii=False)
+        sys.stdout.write("\n")
+        return 2
+    json.dump(result, sys.stdout, indent=2, ensure_ascii=False)
+    sys.stdout.write("\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,222 @@
+"""
+Пул учетных записей отправителя с распределением нагрузки.
+
+По умолчанию все письма уходят от учетной записи Outlook по умолчанию (sender_email).
+Если в config.json задан раздел "sender_pool", письма распределяются между
+несколькими учетными записями Outlook (mail.SendUsingAccount):
+
+    "sender_pool": {
+        "accounts": [
+            {"email": "reports1@company.ru", "max_per_hour": 100, "max_per_day": 500},
+            {"email": "reports2@company.ru", "max_per_hour": 100}
+        ],
+        "strategy": "least_loaded",          # или "round_robin"
+        "pinning": {"7210": "reports1@company.ru"},
+        "cooldown_minutes": 30
+    }
+
+Учетная запись, исчерпавшая квоту или получившая ошибку самой учетной записи
+(не найдена в профиле, ограничение или квота сервера, ошибка входа), исключается
+на cooldown_minutes, а письмо автоматически уходит через следующую. Ошибка самого
+письма (неверный адрес, вложение) не ставит учетную запись на паузу и не
+перебирает пул: другие учетные записи ее не исправят. Склад, закрепленный
+в pinning, отправляется только через свою учетную запись.
+
+Ограничение: перебор срабатывает, только если ошибка возникает сразу в mail.Send()
+(учетная запись не найдена, ошибка входа, Outlook отказался принять письмо). Обычно
+Outlook лишь ставит письмо в "Исходящие", а ограничение или квота сервера приходят
+позже отчетом о недоставке (NDR). Такое письмо уже записано как отправленное,
+учетная запись на паузу не ставится, и письмо через другую учетную запись не уходит.
+От ограничений сервера в этом случае защищают только max_per_hour/max_per_day,
+а отчеты о недоставке нужно отслеживать в почтовом ящике отправителя.
+Счетчики отправок и состояние учетных записей хранятся в logs/sender_pool.json.
+"""
+import os
+import logging
+from datetime import datetime, timedelta
+
+import preflight
+
+DEFAULT_COOLDOWN_MINUTES = 30
+
+# Признаки ошибок учетной записи в тексте ошибки Outlook (остальные ошибки - ошибки письма)
+ACCOUNT_ERROR_MARKERS = (
+    'quota', 'throttl', 'rate limit', 'logon', 'log on', 'authenticat', 'credential',
+    'квот', 'ограничение скорости', 'учетн'
+)
+# Коды MAPI: MAPI_E_LOGON_FAILED, MAPI_E_NETWORK_ERROR
+ACCOUNT_ERROR_CODES = {-2147221231, -2147221227}
+
+
+class AccountError(Exception):
+    """Ошибка учетной записи отправителя: письмо можно отправить через другую."""
+
+
+def is_account_error(error):
+    """Проверяет, что ошибка отправки относится к учетной записи, а не к письму."""
+    codes = set()
+    args = getattr(error, 'args', ())
+    if args and isinstance(args[0], int):
+        codes.add(args[0])
+    # pywintypes.com_error: (hresult, текст, excepinfo, argerr), код в excepinfo[5]
+    if len(args) > 2 and isinstance(args[2], tuple) and len(args[2]) > 5:
+        codes.add(args[2][5])
+    if codes & ACCOUNT_ERROR_CODES:
+        return True
+    text = str(error).lower()
+    return any(marker in text for marker in ACCOUNT_ERROR_MARKERS)
+
+
+def get_state_path():
+    """Возвращает путь к состоянию пула отправителей."""
+    return os.path.join("logs", "sender_pool.json")
+
+
+def load_state():
+    """Загружает состояние пула: {'accounts': {email: {...}}, 'next_index': n}."""
+    data = preflight.load_json(get_state_path())
+    return {'accounts': data.get('accounts', {}), 'next_index': data.get('next_index', 0)}
+
+
+def save_state(state):
+    """Сохраняет состояние пула отправителей."""
+    preflight.save_json(get_state_path(), state)
+
+
+def get_pool_config(config):
+    """Возвращает раздел sender_pool или None, если пул не настроен."""
+    pool_config = config.get('sender_pool') or {}
+    if not pool_config.get('accounts'):
+        return None
+    return pool_config
+
+
+def account_stats(state, email, moment):
+    """Состояние учетной записи с отправками только за последние сутки."""
+    stats = state['accounts'].setdefault(email, {'sent': [], 'throttled_until': None, 'failures': 0})
+    day_ago = (moment - timedelta(days=1)).isoformat()
+    stats['sent'] = [ts for ts in stats['sent'] if ts > day_ago]
+    return stats
+
+
+def is_available(account, stats, moment):
+    """Проверяет, что учетная запись не на паузе и не исчерпала квоту."""
+    if stats.get('throttled_until') and stats['throttled_until'] > moment.isoformat():
+        return False
+    hour_ago = (moment - timedelta(hours=1)).isoformat()
+    max_per_hour = account.get('max_per_hour')
+    if max_per_hour and sum(1 for ts in stats['sent'] if ts > hour_ago) >= max_per_hour:
+        return False
+    max_per_day = account.get('max_per_day')
+    if max_per_day and len(stats['sent']) >= max_per_day:
+        return False
+    return True
+
+
+def load_ratio(account, stats, moment):
+    """Загрузка учетной записи за последний час (доля квоты или число писем)."""
+    hour_ago = (moment - timedelta(hours=1)).isoformat()
+    sent_last_hour = sum(1 for ts in stats['sent'] if ts > hour_ago)
+    max_per_hour = account.get('max_per_hour')
+    return sent_last_hour / max_per_hour if max_per_hour else sent_last_hour
+
+
+def choose_accounts(config, state, warehouse_code, moment):
+    """
+    Возвращает адреса учетных записей в порядке попыток отправки письма склада.
+    Пустой список - пул не настроен (отправка от учетной записи по умолчанию)
+    или все подходящие учетные записи недоступны.
+    """
+    pool_config = get_pool_config(config)
+    if pool_config is None:
+        return []
+    accounts = pool_config['accounts']
+    available = [a for a in accounts if is_available(a, account_stats(state, a['email'], moment), moment)]
+
+    pinned = pool_config.get('pinning', {}).get(warehouse_code)
+    if pinned:
+        return [a['email'] for a in available if a['email'] == pinned]
+
+    if pool_config.get('strategy') == 'round_robin':
+        start = state.get('next_index', 0) % len(accounts)
+        rotation = accounts[start:] + accounts[:start]
+        state['next_index'] = (start + 1) % len(accounts)
+        ordered = [a for a in rotation if a in available]
+    else:
+        ordered = sorted(available, key=lambda a: load_ratio(a, state['accounts'][a['email']], moment))
+    return [a['email'] for a in ordered]
+
+
+def record_result(state, config, email, success, moment):
+    """Учитывает результат отправки: счетчик отправок или пауза после ошибки."""
+    stats = account_stats(state, email, moment)
+    if success:
+        stats['sent'].append(moment.isoformat())
+        stats['failures'] = 0
+        stats['throttled_until'] = None
+    else:
+        pool_config = get_pool_config(config) or {}
+        cooldown = pool_config.get('cooldown_minutes', DEFAULT_COOLDOWN_MINUTES)
+        stats['failures'] = stats.get('failures', 0) + 1
+        stats['throttled_until'] = (moment + timedelta(minutes=cooldown)).isoformat()
+        logging.warning(f"Отправитель {email} недоступен до {stats['throttled_until']} (ошибок подряд: {stats['failures']})")
+
+
+def resolve_account(outlook, email, resolved):
+    """
+    Находит учетную запись Outlook по адресу (None, если не найдена).
+    resolved - словарь найденных учетных записей текущего цикла (адрес -> Account):
+    он создается заново для каждого подключения к Outlook, а ненайденные адреса в нем
+    не запоминаются, чтобы добавленная в профиль учетная запись нашлась в следующем цикле.
+    """
+    cache_key = email.lower()
+    if cache_key in resolved:
+        return resolved[cache_key]
+    account = None
+    try:
+        accounts = outlook.Session.Accounts
+        for index in range(1, accounts.Count + 1):
+            candidate = accounts.Item(index)
+            if str(candidate.SmtpAddress).lower() == email.lower():
+                account = candidate
+                break
+    except Exception as e:
+        logging.error(f"Ошибка получения учетных записей Outlook: {e}")
+        return None
+    if account is None:
+        logging.error(f"Учетная запись {email} не найдена в профиле Outlook")
+    else:
+        resolved[cache_key] = account
+    return account
+
+
+def send_with_pool(config, state, warehouse_code, moment, send):
+    """
+    Отправляет письмо через пул: send(account) вызывается для очередной учетной записи
+    (account=None - учетная запись по умолчанию). send возвращает успех отправки или
+    выбрасывает AccountError - тогда учетная запись ставится на паузу и письмо уходит
+    через следующую. Если письмо не ушло через исправную учетную запись, перебор
+    прекращается. outlook передается в send снаружи; здесь выбирается только отправитель.
+    Возвращает (успех, адрес отправителя или None).
+    """
+    if get_pool_config(config) is None:
+        return send(None), None
+
+    candidates = choose_accounts(config, state, warehouse_code, moment)
+    if not candidates:
+        logging.error(f"Склад {warehouse_code}: нет доступных учетных записей отправителя, письмо отложено")
+        return False, None
+    for email in candidates:
+        try:
+            success = send(email)
+        except AccountError as e:
+            logging.warning(f"Склад {warehouse_code}: учетная запись {email} недоступна ({e}), пробуем следующую")
+            record_result(state, config, email, False, moment)
+            continue
+        if success:
+            record_result(state, config, email, True, moment)
+            return True, email
+        # Ошибка самого письма: другая учетная запись ее не исправит
+        logging.warning(f"Склад {warehouse_code}: письмо не отправлено через исправную учетную запись {email}, перебор пула остановлен")
+        return False, None
+    return False, None
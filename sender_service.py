@@ -1,40 +1,116 @@
-import win32com.client
-import pythoncom
 import os
 import json
-import schedule # Можно удалить, если не используем schedule для основного цикла
 import time
+import signal
 from datetime import datetime, timedelta
 import logging
 
-# Создание папки для логов если не существует
-if not os.path.exists("logs"):
-    os.makedirs("logs")
-
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('logs/service.log', encoding='utf-8'),
-        logging.StreamHandler() # Убрать, если не хотите вывод в консоль сервиса
-    ]
-)
+import checkpoint
+import content_routing
+import prebuild
+import preflight
+import profiling
+import scheduler
+import sender_pool
+import staging
+
+# win32com/pythoncom импортируются внутри connect_outlook, чтобы модуль можно было
+# использовать без Outlook (симулятор, командная строка).
+
+def setup_logging(log_file='logs/service.log', console=True):
+    """Настраивает логирование сервиса в файл и (если console) в консоль."""
+    # Создание папки для логов если не существует
+    log_dir = os.path.dirname(log_file)
+    if log_dir and not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+
+    handlers = [logging.FileHandler(log_file, encoding='utf-8')]
+    if console:
+        handlers.append(logging.StreamHandler())
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=handlers
+    )
+
+# --- ИСТОЧНИК ВРЕМЕНИ И ТРАНСПОРТ ---
+# Правила дат читают время только через now(), а подключение к почте идет через
+# connect_transport(). Симулятор подменяет оба, чтобы прогонять настоящий цикл
+# на виртуальных часах и с локальным транспортом вместо Outlook.
+_clock = datetime.now
+
+def now():
+    """Возвращает текущее время по установленным часам."""
+    return _clock()
+
+def set_clock(clock):
+    """Устанавливает функцию-источник времени (None - системные часы)."""
+    global _clock
+    _clock = clock or datetime.now
+
+def set_transport(connect):
+    """Устанавливает функцию подключения к транспорту (None - Outlook)."""
+    global _connect
+    _connect = connect or connect_outlook
+
+def connect_transport():
+    """Подключается к текущему транспорту отправки."""
+    return _connect()
+
+class TransportUnavailableError(Exception):
+    """Цикл не смог подключиться к транспорту отправки (Outlook)."""
+# --- КОНЕЦ ИСТОЧНИКА ВРЕМЕНИ И ТРАНСПОРТА ---
+
+# --- ОСТАНОВКА СЕРВИСА ---
+# На Windows proc.terminate() завершает процесс без сигнала, поэтому интерфейс
+# просит сервис остановиться файлом-запросом; SIGTERM/SIGINT/SIGBREAK тоже обрабатываются.
+_stop_requested = False
+
+def get_stop_request_path():
+    """Возвращает путь к файлу-запросу остановки сервиса."""
+    return os.path.join("logs", "stop.request")
+
+def request_stop(signum=None, frame=None):
+    """Просит сервис завершиться после текущего письма."""
+    global _stop_requested
+    if not _stop_requested:
+        logging.info(f"Получен запрос остановки сервиса{f' (сигнал {signum})' if signum else ''}")
+    _stop_requested = True
+
+def stop_requested():
+    """Проверяет, запрошена ли остановка сервиса (сигналом или файлом-запросом)."""
+    if not _stop_requested and os.path.exists(get_stop_request_path()):
+        request_stop()
+    return _stop_requested
+# --- КОНЕЦ ОСТАНОВКИ СЕРВИСА ---
 
 # --- ФУНКЦИИ ДЛЯ РАБОТЫ С ЖУРНАЛОМ ОТПРАВЛЕННЫХ ФАЙЛОВ ---
 def get_sent_files_log_path():
     """Возвращает путь к файлу журнала отправленных файлов."""
     return os.path.join("logs", "sent_files.json")
 
+# Журнал в памяти: (путь, размер, время изменения) -> множество имен.
+# Файл перечитывается, только если он изменился с момента последнего чтения или записи.
+_sent_files_cache = (None, None)
+
+def _sent_files_stamp(log_path):
+    st = os.stat(log_path)
+    return (log_path, st.st_size, st.st_mtime_ns)
+
 def load_sent_files():
     """Загружает множество имен уже отправленных файлов."""
+    global _sent_files_cache
     log_path = get_sent_files_log_path()
     if not os.path.exists(log_path):
         return set()
     try:
+        stamp = _sent_files_stamp(log_path)
+        if _sent_files_cache[0] == stamp:
+            return set(_sent_files_cache[1])
         with open(log_path, 'r', encoding='utf-8') as f:
             data = json.load(f)
             if isinstance(data, list):
+                _sent_files_cache = (stamp, frozenset(data))
                 return set(data)
             else:
                 logging.warning(f"Неверный формат sent_files.json. Создается новый.")
@@ -44,12 +120,20 @@ def load_sent_files():
         return set()
 
 def save_sent_files(sent_files_set):
-    """Сохраняет множество имен отправленных файлов."""
+    """
+    Сохраняет множество имен отправленных файлов.
+    Журнал пишется во временный файл и подменяется целиком, чтобы прерванная
+    запись не оставила обрезанный JSON (он читался бы как пустой журнал).
+    """
+    global _sent_files_cache
     log_path = get_sent_files_log_path()
     os.makedirs(os.path.dirname(log_path), exist_ok=True)
+    temp_path = log_path + ".tmp"
     try:
-        with open(log_path, 'w', encoding='utf-8') as f:
+        with open(temp_path, 'w', encoding='utf-8') as f:
             json.dump(list(sent_files_set), f, indent=2, ensure_ascii=False)
+        os.replace(temp_path, log_path)
+        _sent_files_cache = (_sent_files_stamp(log_path), frozenset(sent_files_set))
     except Exception as e:
         logging.error(f"Ошибка сохранения журнала отправленных файлов {log_path}: {e}")
 # --- КОНЕЦ ФУНКЦИЙ ДЛЯ ЖУРНАЛА ---
@@ -69,7 +153,13 @@ def load_config():
             "7210": {"days_offset": 1, "send_on_friday": 3},
             "7220": {"days_offset": 2, "send_on_friday": 4},
             "7230": {"days_offset": 2, "send_on_friday": 4}
-        }
+        },
+        "preflight": dict(preflight.DEFAULT_PREFLIGHT_CONFIG),
+        "staging": dict(staging.DEFAULT_STAGING_CONFIG),
+        "profiling": dict(profiling.DEFAULT_PROFILING_CONFIG),
+        "dispatch": dict(scheduler.DEFAULT_DISPATCH_CONFIG),
+        "content_routing": dict(content_routing.DEFAULT_CONTENT_ROUTING_CONFIG),
+        "prebuild": dict(prebuild.DEFAULT_PREBUILD_CONFIG)
     }
     
     if os.path.exists("config.json"):
@@ -90,6 +180,8 @@ def load_config():
 def connect_outlook():
     """Подключается к Outlook через COM."""
     try:
+        import pythoncom
+        import win32com.client
         pythoncom.CoInitialize()
         outlook = win32com.client.Dispatch("Outlook.Application")
         logging.info("Успешное подключение к Outlook")
@@ -98,16 +190,21 @@ def connect_outlook():
         logging.error(f"Ошибка подключения к Outlook: {str(e)}")
         return None
 
-def get_files_for_sending(folder_path):
+_connect = connect_outlook
+
+def get_files_for_sending(folder_path, config=None, day=None):
     """
     Ищет файлы для отправки на основе настроек date_config.
     Для каждого склада определяет целевую дату файла (сегодня + days_offset или send_on_friday).
     Ищет файлы с датой в формате YYYYMMDD и кодом склада в начале имени.
     Возвращает словарь файлов, подходящих для отправки на основе date_config.
+    Если config не передан, загружается свежая конфигурация.
+    day - день отправки вместо сегодняшнего (для сборки писем заранее).
     """
     try:
-        today_dt_obj = datetime.now()
-        config = load_config() # Всегда загружаем свежую конфигурацию
+        today_dt_obj = day or now()
+        if config is None:
+            config = load_config() # Всегда загружаем свежую конфигурацию
         date_config = config.get('date_config', {})
         email_config = config.get('email_config', {})
 
@@ -122,11 +219,7 @@ def get_files_for_sending(folder_path):
                 logging.debug(f"Пропущен склад {warehouse_code}: нет email в конфигурации.")
                 continue
 
-            days_offset = date_info.get('days_offset', 0)
-            if today_dt_obj.weekday() == 4:  # Пятница
-                days_offset = date_info.get('send_on_friday', days_offset)
-
-            target_date = today_dt_obj + timedelta(days=days_offset)
+            target_date = today_dt_obj + timedelta(days=scheduler.lead_days(date_info, today_dt_obj))
             target_date_str = target_date.strftime('%Y%m%d')
             
             target_dates_per_warehouse[warehouse_code] = {
@@ -141,7 +234,8 @@ def get_files_for_sending(folder_path):
             return {}
 
         try:
-            all_files = os.listdir(folder_path)
+            with profiling.span('listdir'):
+                all_files = checkpoint.list_folder(folder_path)
         except OSError as e:
             logging.error(f"Ошибка доступа к папке {folder_path}: {e}")
             return {}
@@ -149,24 +243,47 @@ def get_files_for_sending(folder_path):
         logging.info(f"Найдено {len(all_files)} файлов в папке {folder_path}")
 
         # 3. Проверим каждый файл
-        for file in all_files:
-            if file.lower().endswith('.xlsx'):
-                # Проверим, соответствует ли файл критериям какого-либо склада
-                for warehouse_code, target_info in target_dates_per_warehouse.items():
-                    target_date_str = target_info['target_date_str']
-                    email = target_info['email']
+        with profiling.span('match'):
+            for file in all_files:
+                if file.lower().endswith('.xlsx'):
+                    # Проверим, соответствует ли файл критериям какого-либо склада
+                    for warehouse_code, target_info in target_dates_per_warehouse.items():
+                        target_date_str = target_info['target_date_str']
+                        email = target_info['email']
                     
-                    # Условие соответствия: имя начинается с кода склада и содержит целевую дату
-                    if file.startswith(f"{warehouse_code}_") and target_date_str in file:
-                        if warehouse_code not in files_ready_to_send:
-                            files_ready_to_send[warehouse_code] = {
-                                'email': email,
-                                'files': []
-                            }
-                        files_ready_to_send[warehouse_code]['files'].append(file)
-                        logging.debug(f"Файл {file} подходит для склада {warehouse_code}")
-                        # Файл может подходить только одному складу из-за уникального префикса, выходим
-                        break 
+                        # Условие соответствия: имя начинается с кода склада и содержит целевую дату
+                        if file.startswith(f"{warehouse_code}_") and target_date_str in file:
+                            if warehouse_code not in files_ready_to_send:
+                                files_ready_to_send[warehouse_code] = {
+                                    'email': email,
+                                    'files': []
+                                }
+                            files_ready_to_send[warehouse_code]['files'].append(file)
+                            logging.debug(f"Файл {file} подходит для склада {warehouse_code}")
+                            # Файл может подходить только одному складу из-за уникального префикса, выходим
+                            break 
+
+        # 4. Файлы, названные не по правилу, маршрутизируем по содержимому книги (если включено)
+        if config.get('content_routing', {}).get('enabled'):
+            prefixes = tuple(f"{warehouse_code}_" for warehouse_code in target_dates_per_warehouse)
+            unnamed_files = [f for f in all_files if f.lower().endswith('.xlsx') and not f.startswith(prefixes)]
+            try:
+                with profiling.span('content_routing'):
+                    routes = content_routing.route_files(folder_path, unnamed_files, config)
+            except Exception as e:
+                # Сбой маршрутизации не должен останавливать отправку файлов, названных по правилу
+                logging.error(f"Ошибка маршрутизации файлов по содержимому: {str(e)}")
+                routes = {}
+            for file, (warehouse_code, date_str) in routes.items():
+                target_info = target_dates_per_warehouse.get(warehouse_code)
+                if target_info and target_info['target_date_str'] == date_str:
+                    if warehouse_code not in files_ready_to_send:
+                        files_ready_to_send[warehouse_code] = {
+                            'email': target_info['email'],
+                            'files': []
+                        }
+                    files_ready_to_send[warehouse_code]['files'].append(file)
+                    logging.debug(f"Файл {file} подходит для склада {warehouse_code} по содержимому")
 
         return files_ready_to_send
 
@@ -174,146 +291,401 @@ def get_files_for_sending(folder_path):
         logging.error(f"Ошибка поиска файлов для отправки: {str(e)}")
         return {}
 
-def send_email(outlook, to_email, subject, body, attachments, folder_path):
-    """Отправляет email через Outlook с вложениями."""
+def send_email(outlook, to_email, subject, body, attachments, folder_path, attachment_paths=None, account=None,
+               before_send=None):
+    """
+    Отправляет email через Outlook с вложениями.
+    attachment_paths - необязательный словарь имя файла -> локальная копия (staging);
+    файлы без локальной копии берутся из folder_path.
+    account - учетная запись Outlook отправителя (None - учетная запись по умолчанию).
+    before_send(mail) вызывается для собранного письма непосредственно перед mail.Send().
+    """
+    attachment_paths = attachment_paths or {}
     try:
-        mail = outlook.CreateItem(0)
-        mail.To = to_email
-        mail.Subject = subject
-        mail.Body = body
-        
-        for attachment in attachments:
-            full_path = os.path.join(folder_path, attachment)
-            if os.path.exists(full_path):
-                mail.Attachments.Add(full_path)
-            else:
-                logging.warning(f"Файл не найден: {full_path}")
-        
-        mail.Send()
+        with profiling.span('build_message'):
+            mail = outlook.CreateItem(0)
+            if account is not None:
+                mail.SendUsingAccount = account
+            mail.To = to_email
+            mail.Subject = subject
+            mail.Body = body
+
+            for attachment in attachments:
+                full_path = attachment_paths.get(attachment) or os.path.join(folder_path, attachment)
+                if os.path.exists(full_path):
+                    mail.Attachments.Add(full_path)
+                else:
+                    logging.warning(f"Файл не найден: {full_path}")
+
+        if before_send is not None:
+            before_send(mail)
+        with profiling.span('mail_send'):
+            mail.Send()
         logging.info(f"Письмо отправлено на {to_email}")
         return True
     except Exception as e:
+        # Ошибку учетной записи из пула отправителей обрабатывает sender_pool
+        if account is not None and sender_pool.is_account_error(e):
+            raise sender_pool.AccountError(str(e)) from e
         logging.error(f"Ошибка отправки письма на {to_email}: {str(e)}")
         return False
 
-def monitor_and_send():
+def send_prebuilt(outlook, entry_id, to_email, account=None, before_send=None):
+    """Отправляет заранее собранное письмо из черновиков Outlook (before_send - как в send_email)."""
+    try:
+        mail = outlook.Session.GetItemFromID(entry_id)
+        if account is not None:
+            mail.SendUsingAccount = account
+        if before_send is not None:
+            before_send(mail)
+        with profiling.span('mail_send'):
+            mail.Send()
+        logging.info(f"Заранее собранное письмо отправлено на {to_email}")
+        return True
+    except Exception as e:
+        if account is not None and sender_pool.is_account_error(e):
+            raise sender_pool.AccountError(str(e)) from e
+        logging.warning(f"Не удалось отправить заранее собранное письмо на {to_email}: {str(e)}. Письмо будет собрано заново.")
+        return False
+
+def message_text(warehouse_code, day):
+    """Тема и текст письма склада за день отправки."""
+    subject = f"Отчеты склада {warehouse_code} за {day.strftime('%d.%m.%Y')}"
+    body = f"Во вложении отчеты склада {warehouse_code} за {day.strftime('%d.%m.%Y')}"
+    return subject, body
+
+def select_new_files(files_ready_to_send, previously_sent_files):
+    """
+    Исключает уже отправленные файлы из результата get_files_for_sending.
+    Возвращает словарь того же вида только со складами, у которых остались новые файлы.
+    """
+    new_files_to_send = {}
+    for warehouse_code, data in files_ready_to_send.items():
+        # Фильтруем список файлов для этого склада, исключая уже отправленные
+        new_files_for_warehouse = [f for f in data['files'] if f not in previously_sent_files]
+        if new_files_for_warehouse:
+            new_files_to_send[warehouse_code] = {
+                'email': data['email'],
+                'files': new_files_for_warehouse
+            }
+    return new_files_to_send
+
+def monitor_and_send(stoppable=False, manual_date=False):
     """
     Основная функция мониторинга папки и отправки новых файлов.
     Эта функция будет вызываться регулярно в цикле.
+    stoppable - цикл запущен сервисом (main) и прерывается по запросу остановки;
+    для разовых запусков (sender_cli, симулятор) запрос остановки сервиса не действует.
+    manual_date - часы переведены на выбранную вручную дату (sender_cli --date, backfill):
+    письма ближайших дней не собираются (иначе будут удалены настоящие черновики сервиса),
+    а ожидание и метрики сроков доставки не записываются.
+    В конце цикла (под той же блокировкой и профилированием) заранее собираются
+    письма ближайших дней.
+    Возвращает список результатов по складам:
+    {'warehouse', 'email', 'files', 'success', 'sender', 'prebuilt'} для каждого отправляемого письма
+    или None, если цикл уже выполняется другим процессом (сервисом или sender_cli).
+    Если есть что отправлять, но подключиться к Outlook не удалось, выбрасывается
+    TransportUnavailableError, чтобы sender_cli не принял это за "нечего отправлять".
     """
+    results = []
+    locked = False
+    config = None
     try:
         logging.info("--- Начало цикла мониторинга ---")
         
         # Проверяем выходной день
-        today = datetime.now()
+        today = now()
         if today.weekday() in [5, 6]:  # Суббота=5, Воскресенье=6
             logging.info("Сегодня выходной день. Мониторинг приостановлен.")
-            return
+            return results
 
-        # Загружаем конфигурацию
+        # Один цикл отправки одновременно: сервис и sender_cli не должны отправлять одни и те же файлы
+        if not checkpoint.acquire_lock():
+            logging.warning("Цикл отправки уже выполняется другим процессом. Цикл пропущен.")
+            return None
+        locked = True
+
+        # Загружаем конфигурацию и при необходимости включаем профилирование цикла
+        cycle_started = time.perf_counter()
         config = load_config()
+        profiling.start_cycle(config, cycle_started)
         folder_path = config['folder_path']
         
         # 1. Получаем список файлов, которые нужно отправить (по date_config)
-        files_ready_to_send = get_files_for_sending(folder_path)
+        with profiling.span('scan'):
+            files_ready_to_send = get_files_for_sending(folder_path, config)
 
         if not files_ready_to_send:
              logging.info("Нет файлов, подходящих для отправки по критериям date_config.")
-             return
+             return results
 
         # 2. Загружаем список уже отправленных файлов
-        previously_sent_files = load_sent_files()
+        with profiling.span('load_sent_log'):
+            previously_sent_files = load_sent_files()
         logging.debug(f"Загружено {len(previously_sent_files)} ранее отправленных файлов.")
 
         # 3. Определяем новые файлы для отправки
-        new_files_to_send = {}
-        total_files_found = 0
-        total_new_files = 0
-        for warehouse_code, data in files_ready_to_send.items():
-            total_files_found += len(data['files'])
-            # Фильтруем список файлов для этого склада, исключая уже отправленные
-            new_files_for_warehouse = [f for f in data['files'] if f not in previously_sent_files]
-            total_new_files += len(new_files_for_warehouse)
-            
-            if new_files_for_warehouse:
-                new_files_to_send[warehouse_code] = {
-                    'email': data['email'],
-                    'files': new_files_for_warehouse
-                }
-        
+        new_files_to_send = select_new_files(files_ready_to_send, previously_sent_files)
+        total_files_found = sum(len(data['files']) for data in files_ready_to_send.values())
+        total_new_files = sum(len(data['files']) for data in new_files_to_send.values())
+
         logging.info(f"Файлов по критериям: {total_files_found}. Новых файлов: {total_new_files}.")
 
         if not new_files_to_send:
             logging.info("Нет новых файлов для отправки.")
-            return
+            return results
 
-        # 4. Подключаемся к Outlook
-        outlook = connect_outlook()
+        # 4. Копируем вложения с сетевой папки на локальный диск (если staging включен)
+        with profiling.span('staging'):
+            staged_paths = staging.stage_files(folder_path, new_files_to_send, config)
+
+        # 5. Проверяем вложения перед отправкой (неисправные файлы уходят в карантин)
+        with profiling.span('preflight'):
+            new_files_to_send = preflight.run_preflight(folder_path, new_files_to_send, config, staged_paths)
+        if not new_files_to_send:
+            logging.info("Все новые файлы в карантине. Отправка не производится.")
+            return results
+
+        # 6. Определяем порядок отправки: ближайший срок доставки первым
+        dispatch_state = scheduler.load_state()
+        dispatch_order = scheduler.plan_dispatch(new_files_to_send, config, today, dispatch_state)
+
+        # 7. Подключаемся к Outlook
+        with profiling.span('connect'):
+            outlook = connect_transport()
         if not outlook:
             logging.error("Не удалось подключиться к Outlook. Повторная попытка через интервал.")
-            return
-
-        # 5. Отправляем письма
+            if not manual_date:
+                scheduler.save_state(dispatch_state)
+            raise TransportUnavailableError("Не удалось подключиться к Outlook")
+
+        # Прерванные отправки прошлого запуска сверяем с папкой "Отправленные"
+        recovered_files, unverified_files = checkpoint.recover_in_flight(outlook)
+        if recovered_files:
+            previously_sent_files = previously_sent_files.union(recovered_files)
+            save_sent_files(previously_sent_files)
+        if recovered_files or unverified_files:
+            new_files_to_send = select_new_files(new_files_to_send, recovered_files | unverified_files)
+            dispatch_order = [code for code in dispatch_order if code in new_files_to_send]
+
+        # 8. Отправляем письма (состояние сохраняется в контрольной точке после каждого письма)
         success_count = 0
         newly_sent_files = set() # Собираем файлы, отправленные в этом цикле
+        pool_state = sender_pool.load_state()
+        resolved_accounts = {} # Учетные записи пула, найденные в этом подключении к Outlook
+        prebuilt_manifest = prebuild.load_manifest()
+        checkpoint.set_pending({code: new_files_to_send[code] for code in dispatch_order})
         
-        for warehouse_code, data in new_files_to_send.items():
+        for warehouse_code in dispatch_order:
+            if stoppable and stop_requested():
+                logging.info("Остановка сервиса: оставшиеся письма будут отправлены после перезапуска.")
+                break
+            data = new_files_to_send[warehouse_code]
             if not data['files']: # На всякий случай
                  continue
 
-            subject = f"Отчеты склада {warehouse_code} за {today.strftime('%d.%m.%Y')}"
-            body = f"Во вложении отчеты склада {warehouse_code} за {today.strftime('%d.%m.%Y')}"
-
-            success = send_email(
-                outlook,
-                data['email'],
-                subject,
-                body,
-                data['files'],
-                folder_path
-            )
+            subject, body = message_text(warehouse_code, today)
+            # Письмо, собранное заранее из тех же файлов, остается только отправить
+            prebuilt_entry = None
+            prebuilt_sent = []
+            if prebuilt_manifest:
+                prebuilt_entry = prebuild.find_ready(prebuilt_manifest, today, warehouse_code,
+                                                     prebuild.signature(folder_path, data, subject))
+
+            key = checkpoint.idempotency_key(warehouse_code, data['email'], data['files'])
+            def mark_in_flight(mail):
+                # Ключ в письме позволяет после сбоя найти его в папке "Отправленные"
+                checkpoint.tag_mail(mail, key)
+                checkpoint.begin_send(key, warehouse_code, data['email'], data['files'], subject)
+            def send_from(sender):
+                # sender - адрес учетной записи из пула (None - учетная запись по умолчанию)
+                account = None
+                if sender is not None:
+                    account = sender_pool.resolve_account(outlook, sender, resolved_accounts)
+                    if account is None:
+                        raise sender_pool.AccountError("учетная запись не найдена в профиле Outlook")
+                if prebuilt_entry and send_prebuilt(outlook, prebuilt_entry['entry_id'], data['email'], account, mark_in_flight):
+                    prebuilt_sent.append(sender)
+                    return True
+                return send_email(
+                    outlook,
+                    data['email'],
+                    subject,
+                    body,
+                    data['files'],
+                    folder_path,
+                    staged_paths,
+                    account,
+                    mark_in_flight
+                )
+
+            success, sender = sender_pool.send_with_pool(config, pool_state, warehouse_code, now(), send_from)
             
+            results.append({
+                'warehouse': warehouse_code,
+                'email': data['email'],
+                'files': data['files'],
+                'success': success,
+                'sender': sender,
+                'prebuilt': bool(prebuilt_sent)
+            })
             if success:
                 success_count += 1
-                logging.info(f"Письмо для склада {warehouse_code} успешно отправлено на {data['email']} ({len(data['files'])} файлов)")
+                if not manual_date:
+                    scheduler.record_send(dispatch_state, warehouse_code, config.get('date_config', {}).get(warehouse_code, {}), now())
+                logging.info(f"Письмо для склада {warehouse_code} успешно отправлено на {data['email']} ({len(data['files'])} файлов){f' от {sender}' if sender else ''}")
                 newly_sent_files.update(data['files']) # Добавляем в список отправленных
+                # Сразу фиксируем отправку в журнале, чтобы перезапуск не отправил письмо повторно
+                with profiling.span('save_sent_log'):
+                    save_sent_files(previously_sent_files.union(newly_sent_files))
+                checkpoint.finish_send(key, warehouse_code)
+                if prebuilt_sent:
+                    # Черновик отправлен; если письмо собрано заново, черновик удалится при очистке
+                    prebuilt_manifest.pop(prebuild.message_key(today, warehouse_code), None)
+                    prebuild.save_manifest(prebuilt_manifest)
             else:
+                checkpoint.abort_send(key)
                 logging.error(f"Ошибка отправки письма для склада {warehouse_code} на {data['email']}")
 
-        logging.info(f"Цикл мониторинга завершен. Успешно отправлено: {success_count}/{len(new_files_to_send)} складов.")
+        logging.info(f"Цикл мониторинга завершен. Успешно отправлено: {success_count}/{len(dispatch_order)} складов.")
+        if not manual_date:
+            scheduler.save_state(dispatch_state)
+        if sender_pool.get_pool_config(config) is not None:
+            sender_pool.save_state(pool_state)
 
-        # 6. Обновляем журнал отправленных файлов
+        # 9. Журнал отправленных файлов уже обновлен после каждого письма
         if newly_sent_files:
-            updated_sent_files = previously_sent_files.union(newly_sent_files)
-            save_sent_files(updated_sent_files)
             logging.info(f"Журнал отправленных файлов обновлен. Добавлено {len(newly_sent_files)} файлов.")
+            # Локальные копии отправленных файлов больше не нужны
+            staging.release_files(newly_sent_files, config)
             
+    except TransportUnavailableError:
+        raise
     except Exception as e:
         logging.error(f"Критическая ошибка в цикле мониторинга: {str(e)}")
+    finally:
+        if locked:
+            if config is not None and not manual_date and not (stoppable and stop_requested()):
+                with profiling.span('look_ahead', nested=True):
+                    prepare_upcoming_files(config)
+            checkpoint.release_lock()
+        profiling.finish_cycle()
+    return results
+
+
+def prepare_upcoming_files(config):
+    """
+    Просматривает папку наперед на ближайшие рабочие дни отправки: файлы, которые уже
+    лежат в папке, копируются в staging (staging.lookahead_days), а письма для них
+    заранее собираются в черновиках (prebuild.lookahead_days). Вызывается в конце каждого цикла.
+    """
+    try:
+        staging_config = staging.get_staging_config(config)
+        prebuild_config = prebuild.get_prebuild_config(config)
+        staging_days = int(staging_config.get('lookahead_days', 0)) if staging_config.get('enabled') else 0
+        prebuild_days = int(prebuild_config.get('lookahead_days', 0)) if prebuild_config.get('enabled') else 0
+        if not staging_days and not prebuild_days:
+            return
+        today = now()
+        folder_path = config['folder_path']
+        sent_files = load_sent_files()
+
+        # Группы ближайших дней: ключ письма -> (день, склад, файлы)
+        upcoming = {}
+        for days_ahead in range(1, max(staging_days, prebuild_days) + 1):
+            day = today + timedelta(days=days_ahead)
+            if day.weekday() in [5, 6]:  # В выходные сервис не отправляет
+                continue
+            groups = select_new_files(get_files_for_sending(folder_path, config, day), sent_files)
+            for warehouse_code, data in groups.items():
+                upcoming[prebuild.message_key(day, warehouse_code)] = (day, warehouse_code, data)
+
+        # Копируем файлы на локальный диск сразу после появления, а не в день отправки
+        with profiling.span('staging'):
+            staged_paths = staging.stage_files(
+                folder_path,
+                {key: data for key, (day, _, data) in upcoming.items() if days_ahead_of(today, day) <= staging_days},
+                config
+            )
+        if not prebuild_days:
+            return
+
+        with profiling.span('preflight'):
+            checked = preflight.run_preflight(
+                folder_path,
+                {key: data for key, (day, _, data) in upcoming.items() if days_ahead_of(today, day) <= prebuild_days},
+                config,
+                staged_paths
+            )
+        wanted = {}
+        for key, data in checked.items():
+            day, warehouse_code, _ = upcoming[key]
+            subject, body = message_text(warehouse_code, day)
+            wanted[key] = {
+                'day': day,
+                'warehouse': warehouse_code,
+                'signature': prebuild.signature(folder_path, data, subject),
+                'body': body,
+                'paths': [staged_paths.get(f) or os.path.join(folder_path, f) for f in data['files']]
+            }
+
+        with profiling.span('prebuild'):
+            manifest = prebuild.load_manifest()
+            if prebuild.sync(connect_transport, manifest, wanted, today):
+                prebuild.save_manifest(manifest)
+    except Exception as e:
+        logging.error(f"Ошибка подготовки файлов ближайших дней: {str(e)}")
+
+
+def days_ahead_of(today, day):
+    """Сколько дней от today до day."""
+    return (day.date() - today.date()).days
 
 
 def main():
     """Главная функция сервиса - запуск цикла мониторинга."""
     logging.info("Сервис автоматической отправки (режим мониторинга) запущен")
     
+    # Корректная остановка по сигналу: текущее письмо дописывается, контрольная точка сохраняется
+    for signal_name in ('SIGTERM', 'SIGINT', 'SIGBREAK'):
+        if hasattr(signal, signal_name):
+            signal.signal(getattr(signal, signal_name), request_stop)
+    # Старый запрос остановки относится к предыдущему запуску
+    if os.path.exists(get_stop_request_path()):
+        os.remove(get_stop_request_path())
+
+    # Прерванные отправки сверяются с папкой "Отправленные" в первом цикле с подключением к Outlook
+    checkpoint.log_unfinished()
+
     # Можно загрузить начальную конфигурацию для лога
     config = load_config()
     logging.info(f"Мониторинг папки: {config.get('folder_path', 'Не указана')}")
     logging.info("Проверка новых файлов будет выполняться каждую минуту.")
 
-    # Бесконечный цикл мониторинга
-    while True:
+    # Цикл мониторинга до запроса остановки
+    while not stop_requested():
         try:
-            monitor_and_send()
+            monitor_and_send(stoppable=True)
+        except TransportUnavailableError:
+            pass # Уже записано в лог, повторная попытка в следующем цикле
         except Exception as e:
             logging.error(f"Неожиданная ошибка в основном цикле: {e}")
         
-        # Ждем 60 секунд перед следующей проверкой
+        # Ждем 60 секунд перед следующей проверкой, проверяя запрос остановки каждую секунду
         # Это интервал мониторинга. Можно сделать короче (30 сек) или длиннее (5 мин)
-        time.sleep(60) 
+        for _ in range(60):
+            if stop_requested():
+                break
+            time.sleep(1)
+
+    # Контрольная точка записывается в конце каждого цикла
+    if os.path.exists(get_stop_request_path()):
+        os.remove(get_stop_request_path())
+    logging.info("Сервис автоматической отправки остановлен, контрольная точка сохранена")
 
 if __name__ == "__main__":
     # Убедимся, что папка логов существует при запуске
     if not os.path.exists("logs"):
         os.makedirs("logs")
+    setup_logging()
     main()
@@ -0,0 +1,340 @@
+"""
+Симулятор сервиса отправки на виртуальных часах.
+
+Прогоняет настоящий цикл monitor_and_send из sender_service.py на сгенерированной
+временной шкале появления файлов в папке. Вместо Outlook используется локальный
+транспорт-приемник, который только записывает письма. Позволяет проверить правила
+дат (days_offset, send_on_friday, выходные) на годах работы и измерить стоимость
+одного цикла.
+
+Цикл выполняется полностью, включая запись состояния в logs/ (контрольная точка,
+журнал отправленных файлов, кэш проверки) после каждого письма, поэтому скорость -
+порядка сотен симулированных дней в секунду (год работы - несколько секунд),
+а не тысячи. Чтобы эти записи не упирались в диск, рабочая папка симуляции по
+возможности создается в памяти (tmpfs /dev/shm в Linux).
+
+Запуск:
+    python simulator.py --start 2025-01-06 --days 365 --report logs/simulation.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import zipfile
+from io import BytesIO
+from datetime import datetime, timedelta
+
+import checkpoint
+import sender_service
+
+# Папка в оперативной памяти для рабочей папки симуляции (если есть в системе)
+MEMORY_DIR = "/dev/shm"
+
+
+class VirtualClock:
+    """Виртуальные часы: возвращают установленное время вместо системного."""
+
+    def __init__(self, start):
+        self.current = start
+
+    def __call__(self):
+        return self.current
+
+    def set(self, moment):
+        self.current = moment
+
+
+class SinkAttachments:
+    """Вложения письма локального транспорта (аналог mail.Attachments)."""
+
+    def __init__(self):
+        self.paths = []
+
+    def Add(self, path):
+        self.paths.append(path)
+
+
+class SinkPropertyAccessor:
+    """MAPI-свойства письма локального транспорта (аналог mail.PropertyAccessor)."""
+
+    def __init__(self):
+        self.properties = {}
+
+    def SetProperty(self, schema_name, value):
+        self.properties[schema_name] = value
+
+    def GetProperty(self, schema_name):
+        return self.properties[schema_name]
+
+
+class SinkMail:
+    """Письмо локального транспорта (аналог Outlook MailItem)."""
+
+    def __init__(self, transport):
+        self._transport = transport
+        self.To = ""
+        self.Subject = ""
+        self.Body = ""
+        self.Attachments = SinkAttachments()
+        self.PropertyAccessor = SinkPropertyAccessor()
+        self.EntryID = None
+        self.saved_at = None
+
+    def Save(self):
+        self._transport.save_draft(self)
+
+    def Delete(self):
+        self._transport.drafts.pop(self.EntryID, None)
+
+    def Send(self):
+        self._transport.drafts.pop(self.EntryID, None)
+        self._transport.deliver(self)
+
+
+class SinkSession:
+    """Сессия локального транспорта (аналог outlook.Session) для черновиков."""
+
+    def __init__(self, transport):
+        self._transport = transport
+
+    def GetItemFromID(self, entry_id):
+        if entry_id not in self._transport.drafts:
+            raise KeyError(f"Черновик {entry_id} не найден")
+        return self._transport.drafts[entry_id]
+
+
+class SinkTransport:
+    """
+    Локальный транспорт-приемник вместо Outlook.
+    Повторяет интерфейс outlook.CreateItem(0) и записывает каждое "отправленное" письмо
+    вместе с виртуальным временем отправки.
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.sent = []
+        self.drafts = {}
+        self.Session = SinkSession(self)
+
+    def CreateItem(self, item_type):
+        return SinkMail(self)
+
+    def save_draft(self, mail):
+        if mail.EntryID is None:
+            mail.EntryID = f"draft-{len(self.sent)}-{len(self.drafts)}-{id(mail)}"
+        mail.saved_at = self.clock()
+        self.drafts[mail.EntryID] = mail
+
+    def deliver(self, mail):
+        self.sent.append({
+            'sent_at': self.clock(),
+            'to': mail.To,
+            'subject': mail.Subject,
+            'attachments': [os.path.basename(p) for p in mail.Attachments.paths],
+            'prebuilt_at': mail.saved_at
+        })
+
+
+def parse_time(value):
+    """Преобразует строку ЧЧ:ММ в timedelta от начала суток."""
+    hours, minutes = value.split(':')
+    return timedelta(hours=int(hours), minutes=int(minutes))
+
+
+def make_workbook_bytes():
+    """Содержимое минимального .xlsx, проходящего предварительную проверку вложений."""
+    buffer = BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive:
+        archive.writestr('[Content_Types].xml', '<?xml version="1.0"?><Types/>' + ' ' * 2048)
+    return buffer.getvalue()
+
+
+def generate_timeline(date_config, start, days, arrival="08:00", lead_days=5):
+    """
+    Генерирует временную шкалу появления файлов в папке.
+    Для каждого склада и каждой даты документа файл "{склад}_{ГГГГММДД}_report.xlsx"
+    появляется за lead_days дней до своей даты в момент arrival.
+    Возвращает список (момент появления, имя файла), отсортированный по времени.
+    """
+    arrival_delta = parse_time(arrival)
+    start_day = datetime(start.year, start.month, start.day)
+    timeline = []
+    for day_index in range(days + lead_days + 1):
+        document_date = start_day + timedelta(days=day_index)
+        appears_at = document_date - timedelta(days=lead_days) + arrival_delta
+        for warehouse_code in date_config:
+            file_name = f"{warehouse_code}_{document_date.strftime('%Y%m%d')}_report.xlsx"
+            timeline.append((appears_at, file_name))
+    timeline.sort(key=lambda item: item[0])
+    return timeline
+
+
+def describe_message(message):
+    """Дополняет запись письма складом, датами файлов и опережением в днях."""
+    sent_day = message['sent_at'].date()
+    file_dates = []
+    warehouse_code = None
+    for file_name in message['attachments']:
+        parts = file_name.split('_')
+        warehouse_code = parts[0]
+        if len(parts) > 1:
+            try:
+                file_dates.append(datetime.strptime(parts[1], '%Y%m%d').date())
+            except ValueError:
+                pass
+    return {
+        'sent_at': message['sent_at'].isoformat(),
+        'weekday': message['sent_at'].strftime('%a'),
+        'warehouse': warehouse_code,
+        'to': message['to'],
+        'subject': message['subject'],
+        'attachments': message['attachments'],
+        'file_dates': [d.isoformat() for d in file_dates],
+        'lead_days': [(d - sent_day).days for d in file_dates],
+        'prebuilt_at': message['prebuilt_at'].isoformat() if message['prebuilt_at'] else None
+    }
+
+
+def run_simulation(config, start, days, cycle_times=("09:00", "13:00", "17:00"),
+                   arrival="08:00", lead_days=5, retention_days=14, workdir=None):
+    """
+    Прогоняет настоящий цикл сервиса на виртуальных часах.
+
+    config       - конфигурация сервиса (folder_path будет заменен на папку симуляции)
+    start, days  - первый день и длительность симуляции
+    cycle_times  - моменты запуска цикла мониторинга в течение суток
+    arrival      - время появления файлов в папке
+    lead_days    - за сколько дней до своей даты файл появляется в папке
+    retention_days - через сколько дней после появления файл убирается из папки (0 - никогда)
+
+    Возвращает словарь с письмами и статистикой стоимости цикла.
+    """
+    own_workdir = workdir is None
+    workdir = workdir or tempfile.mkdtemp(prefix="auto_sender_sim_", dir=MEMORY_DIR if os.path.isdir(MEMORY_DIR) else None)
+    folder_path = os.path.join(workdir, "reports")
+    os.makedirs(folder_path, exist_ok=True)
+    os.makedirs(os.path.join(workdir, "logs"), exist_ok=True)
+
+    sim_config = dict(config)
+    sim_config['folder_path'] = folder_path
+    with open(os.path.join(workdir, "config.json"), 'w', encoding='utf-8') as f:
+        json.dump(sim_config, f, indent=2, ensure_ascii=False)
+
+    start_day = datetime(start.year, start.month, start.day)
+    timeline = generate_timeline(sim_config.get('date_config', {}), start_day, days, arrival, lead_days)
+    cycle_offsets = sorted(parse_time(t) for t in cycle_times)
+    workbook_bytes = make_workbook_bytes()
+
+    clock = VirtualClock(start_day)
+    transport = SinkTransport(clock)
+    sender_service.set_clock(clock)
+    sender_service.set_transport(lambda: transport)
+
+    original_cwd = os.getcwd()
+    os.chdir(workdir)
+    checkpoint.reset()
+    cycle_costs = []
+    present_files = []
+    next_event = 0
+    wall_start = time.perf_counter()
+    try:
+        for day_index in range(days):
+            day = start_day + timedelta(days=day_index)
+            for offset in cycle_offsets:
+                moment = day + offset
+                clock.set(moment)
+
+                # Выкладываем в папку файлы, появившиеся к этому моменту
+                while next_event < len(timeline) and timeline[next_event][0] <= moment:
+                    appears_at, file_name = timeline[next_event]
+                    with open(os.path.join(folder_path, file_name), 'wb') as f:
+                        f.write(workbook_bytes)
+                    present_files.append((appears_at, file_name))
+                    next_event += 1
+
+                # Убираем из папки устаревшие файлы (архивирование)
+                if retention_days:
+                    expire_before = moment - timedelta(days=retention_days)
+                    while present_files and present_files[0][0] < expire_before:
+                        _, file_name = present_files.pop(0)
+                        os.remove(os.path.join(folder_path, file_name))
+
+                cycle_start = time.perf_counter()
+                sender_service.monitor_and_send()
+                cycle_costs.append(time.perf_counter() - cycle_start)
+    finally:
+        wall_time = time.perf_counter() - wall_start
+        os.chdir(original_cwd)
+        checkpoint.reset()
+        sender_service.set_clock(None)
+        sender_service.set_transport(None)
+        if own_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    cycle_costs.sort()
+    cycles = len(cycle_costs)
+    stats = {
+        'start': start_day.date().isoformat(),
+        'days': days,
+        'cycles': cycles,
+        'messages': len(transport.sent),
+        'prebuilt_messages': sum(1 for m in transport.sent if m['prebuilt_at']),
+        'wall_time_sec': round(wall_time, 3),
+        'days_per_sec': round(days / wall_time, 1) if wall_time else None,
+        'cycle_mean_ms': round(sum(cycle_costs) / cycles * 1000, 3) if cycles else None,
+        'cycle_p95_ms': round(cycle_costs[int(cycles * 0.95) - 1] * 1000, 3) if cycles else None,
+        'cycle_max_ms': round(cycle_costs[-1] * 1000, 3) if cycles else None
+    }
+    return {
+        'stats': stats,
+        'messages': [describe_message(m) for m in transport.sent]
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Симуляция сервиса отправки на виртуальных часах")
+    parser.add_argument("--config", default="config.json", help="Файл конфигурации (по умолчанию config.json)")
+    parser.add_argument("--start", default=None, help="Первый день симуляции ГГГГ-ММ-ДД (по умолчанию сегодня)")
+    parser.add_argument("--days", type=int, default=365, help="Количество симулируемых дней")
+    parser.add_argument("--cycle-times", default="09:00,13:00,17:00", help="Моменты цикла мониторинга через запятую")
+    parser.add_argument("--arrival", default="08:00", help="Время появления файлов в папке")
+    parser.add_argument("--lead-days", type=int, default=5, help="За сколько дней до своей даты файл появляется")
+    parser.add_argument("--retention-days", type=int, default=14, help="Сколько дней файл остается в папке (0 - всегда)")
+    parser.add_argument("--report", default=None, help="Сохранить полный отчет о письмах в JSON-файл")
+    parser.add_argument("--verbose", action="store_true", help="Не отключать логирование сервиса")
+    args = parser.parse_args(argv)
+
+    try:
+        with open(args.config, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+    except (OSError, ValueError) as e:
+        sys.stderr.write(f"Не удалось прочитать {args.config} ({e}). Используются настройки по умолчанию.\n")
+        config = sender_service.load_config()
+    start = datetime.strptime(args.start, '%Y-%m-%d') if args.start else datetime.now()
+
+    if not args.verbose:
+        logging.disable(logging.CRITICAL)
+    result = run_simulation(
+        config,
+        start,
+        args.days,
+        cycle_times=[t.strip() for t in args.cycle_times.split(',') if t.strip()],
+        arrival=args.arrival,
+        lead_days=args.lead_days,
+        retention_days=args.retention_days
+    )
+    logging.disable(logging.NOTSET)
+
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+    json.dump(result['stats'], sys.stdout, indent=2, ensure_ascii=False)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
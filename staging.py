@@ -0,0 +1,186 @@
+"""
+Локальная копия вложений из медленной сетевой папки.
+
+Как только сервис находит новые файлы - в том числе файлы ближайших дней отправки
+(lookahead_days) при просмотре папки наперед в конце цикла, - они параллельно
+копируются в локальную папку staging. Копия проверяется по размеру и контрольной
+сумме SHA-256, поэтому в день отправки письмо собирается из готовой локальной копии,
+а сетевой диск не читается.
+Размер папки ограничен: при переполнении удаляются давно не использованные копии
+(LRU). После успешной отправки копии удаляются.
+
+Индекс копий хранится в staging/index.json: имя -> {fingerprint, size, sha256, last_used}.
+"""
+import os
+import hashlib
+import logging
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import preflight
+
+DEFAULT_STAGING_CONFIG = {
+    "enabled": False,
+    "dir": "staging",
+    "max_size_mb": 500,
+    "workers": 4,
+    "lookahead_days": 3
+}
+
+# Размер блока при копировании и подсчете контрольной суммы
+CHUNK_SIZE = 1024 * 1024
+
+
+def get_staging_config(config):
+    """Возвращает настройки staging с подставленными значениями по умолчанию."""
+    staging_config = dict(DEFAULT_STAGING_CONFIG)
+    staging_config.update(config.get('staging', {}))
+    return staging_config
+
+
+def get_index_path(staging_dir):
+    """Возвращает путь к индексу локальных копий."""
+    return os.path.join(staging_dir, "index.json")
+
+
+def load_index(staging_dir):
+    """Загружает индекс локальных копий."""
+    return preflight.load_json(get_index_path(staging_dir))
+
+
+def save_index(staging_dir, index):
+    """Сохраняет индекс локальных копий."""
+    preflight.save_json(get_index_path(staging_dir), index)
+
+
+def file_sha256(path):
+    """Считает SHA-256 файла блоками."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def copy_and_verify(source_path, local_path):
+    """
+    Копирует файл, считая контрольную сумму по ходу чтения источника,
+    затем сверяет размер и контрольную сумму локальной копии.
+    Возвращает запись индекса или None, если копия не совпала с источником.
+    """
+    st = os.stat(source_path)
+    temp_path = local_path + ".part"
+    digest = hashlib.sha256()
+    with open(source_path, 'rb') as src, open(temp_path, 'wb') as dst:
+        for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+            dst.write(chunk)
+    source_sha = digest.hexdigest()
+    local_size = os.path.getsize(temp_path)
+    if local_size != st.st_size or file_sha256(temp_path) != source_sha:
+        os.remove(temp_path)
+        return None
+    os.replace(temp_path, local_path)
+    return {
+        'fingerprint': f"{st.st_size}:{st.st_mtime_ns}",
+        'size': local_size,
+        'sha256': source_sha
+    }
+
+
+def evict(staging_dir, index, max_bytes, keep):
+    """Удаляет давно не использованные копии, пока папка не уложится в max_bytes."""
+    total = sum(entry.get('size', 0) for entry in index.values())
+    for name in sorted(index, key=lambda n: index[n].get('last_used', '')):
+        if total <= max_bytes:
+            break
+        if name in keep:
+            continue
+        total -= index[name].get('size', 0)
+        remove_copy(staging_dir, index, name)
+        logging.debug(f"Staging: удалена давно не использованная копия {name}")
+
+
+def remove_copy(staging_dir, index, name):
+    """Удаляет локальную копию и ее запись в индексе."""
+    index.pop(name, None)
+    try:
+        os.remove(os.path.join(staging_dir, name))
+    except OSError:
+        pass
+
+
+def stage_files(folder_path, files_to_send, config):
+    """
+    Копирует вложения всех групп в локальную папку staging.
+    files_to_send - словарь вида результата select_new_files.
+    Возвращает словарь имя файла -> путь к проверенной локальной копии.
+    Файлы, которые не удалось скопировать, в словарь не попадают и
+    отправляются напрямую из исходной папки.
+    """
+    staging_config = get_staging_config(config)
+    if not staging_config.get('enabled'):
+        return {}
+
+    staging_dir = staging_config['dir']
+    os.makedirs(staging_dir, exist_ok=True)
+    index = load_index(staging_dir)
+    now_str = datetime.now().isoformat()
+
+    names = [f for data in files_to_send.values() for f in data['files']]
+    staged = {}
+    to_copy = []
+    for name in names:
+        source_path = os.path.join(folder_path, name)
+        local_path = os.path.join(staging_dir, name)
+        try:
+            st = os.stat(source_path)
+        except OSError as e:
+            logging.warning(f"Staging: исходный файл недоступен {source_path}: {e}")
+            continue
+        entry = index.get(name)
+        if entry and entry.get('fingerprint') == f"{st.st_size}:{st.st_mtime_ns}" and os.path.exists(local_path):
+            entry['last_used'] = now_str
+            staged[name] = local_path
+        else:
+            to_copy.append(name)
+
+    if to_copy:
+        def copy_one(name):
+            try:
+                return copy_and_verify(os.path.join(folder_path, name), os.path.join(staging_dir, name))
+            except OSError as e:
+                logging.warning(f"Staging: ошибка копирования {name}: {e}")
+                return None
+
+        workers = max(1, min(int(staging_config.get('workers', 4)), len(to_copy)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            copied = list(executor.map(copy_one, to_copy))
+        for name, entry in zip(to_copy, copied):
+            if entry is None:
+                logging.warning(f"Staging: копия {name} не совпала с источником, файл будет отправлен из исходной папки")
+                remove_copy(staging_dir, index, name)
+                continue
+            entry['last_used'] = now_str
+            index[name] = entry
+            staged[name] = os.path.join(staging_dir, name)
+        copied_count = sum(1 for entry in copied if entry is not None)
+        logging.info(f"Staging: скопировано {copied_count} из {len(to_copy)} файлов")
+
+    evict(staging_dir, index, staging_config.get('max_size_mb', 500) * 1024 * 1024, keep=set(staged))
+    save_index(staging_dir, index)
+    return staged
+
+
+def release_files(file_names, config):
+    """Удаляет локальные копии отправленных файлов."""
+    staging_config = get_staging_config(config)
+    if not staging_config.get('enabled'):
+        return
+    staging_dir = staging_config['dir']
+    if not os.path.isdir(staging_dir):
+        return
+    index = load_index(staging_dir)
+    for name in file_names:
+        remove_copy(staging_dir, index, name)
+    save_index(staging_dir, index)